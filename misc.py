@@ -29,6 +29,7 @@ from gi.repository import Gtk
 from gi.repository import GLib
 import hashlib
 import os
+import sqlite3
 import struct
 import time
 import threading
@@ -183,18 +184,54 @@ def quote_uri(uri):
     # RFC 2396. It is quite tricky to handle all corner cases, leave it to Gst:
     return Gst.filename_to_uri(raw_path)
 
-def hash_file(uri):
-    """Hashes the first 256KB of the specified file"""
-    sha256 = hashlib.sha256()
-    with open(uri, "rb") as file:
-        for _ in range(1024):
-            chunk = file.read(256)
-            if not chunk:
-                break
-            sha256.update(chunk)
+FINGERPRINT_CHUNK_SIZE = 256 * 1024
+
+
+def hash_file(path):
+    """Fingerprints the specified file by hashing its size along with 256KB
+    of its head, middle and tail"""
+    size = os.path.getsize(path)
+    sha256 = hashlib.sha256(struct.pack("<Q", size))
+    with open(path, "rb") as file:
+        if size <= 3 * FINGERPRINT_CHUNK_SIZE:
+            sha256.update(file.read())
+        else:
+            for offset in (0, (size - FINGERPRINT_CHUNK_SIZE) // 2,
+                           size - FINGERPRINT_CHUNK_SIZE):
+                file.seek(offset)
+                sha256.update(file.read(FINGERPRINT_CHUNK_SIZE))
     return sha256.hexdigest()
 
 
+class FingerprintIndex(object):
+    """
+    Remembers the L{hash_file} of files in an sqlite db, until their
+    modification time, inode or size change.
+    """
+
+    def __init__(self, dbfile):
+        self.conn = sqlite3.connect(dbfile)
+        self.cur = self.conn.cursor()
+        self.cur.execute("CREATE TABLE IF NOT EXISTS Fingerprints (Path TEXT NOT NULL PRIMARY KEY,\
+            Mtime REAL NOT NULL, Inode INTEGER NOT NULL, Size INTEGER NOT NULL, Hash TEXT NOT NULL)")
+
+    def fingerprint(self, path):
+        """
+        @returns: the L{hash_file} of path, only computed if path changed.
+        """
+        stat = os.stat(path)
+        self.cur.execute("SELECT Mtime, Inode, Size, Hash FROM Fingerprints WHERE Path = ?", (path,))
+        row = self.cur.fetchone()
+        if row and row[:3] == (stat.st_mtime, stat.st_ino, stat.st_size):
+            return row[3]
+
+        hash = hash_file(path)
+        with self.conn:
+            self.cur.execute("INSERT OR REPLACE INTO Fingerprints VALUES (?,?,?,?,?)",
+                             (path, stat.st_mtime, stat.st_ino, stat.st_size, hash))
+        return hash
+
+
 #------------------------------ Gst helpers   --------------------------------#
 def get_controllable_properties(element):
     """
@@ -288,6 +325,81 @@ def start_bisect_left(a, x, lo=0, hi=None):
     return lo
 
 
+class _StartBoundary(object):
+    """Stand-in used to bisect lists of objects having a start attribute"""
+    __slots__ = ("start",)
+
+    def __init__(self, start):
+        self.start = start
+
+
+class IntervalIndex(object):
+    """
+    Index of objects having C{start} and C{end} attributes, answering which
+    of them overlap a given range in O(log n + k).
+
+    The objects are kept sorted by start along with the running maximum of
+    their ends, which is recomputed lazily from the first modified position.
+    The start and end attributes of indexed objects must only be changed
+    through L{move}.
+    """
+
+    def __init__(self):
+        self._items = []
+        self._maxEnds = []
+        self._dirtyFrom = 0
+
+    def add(self, item):
+        index = start_bisect_left(self._items, item)
+        self._items.insert(index, item)
+        self._dirtyFrom = min(self._dirtyFrom, index)
+
+    def remove(self, item):
+        index = start_bisect_left(self._items, item)
+        while self._items[index] is not item:
+            index += 1
+        del self._items[index]
+        self._dirtyFrom = min(self._dirtyFrom, index)
+
+    def move(self, item, start, end):
+        self.remove(item)
+        item.start = start
+        item.end = end
+        self.add(item)
+
+    def overlapping(self, start, end):
+        """
+        Returns the items overlapping the [start, end[ range, sorted by start.
+        """
+        self._updateMaxEnds()
+        # Everything before lo ends before start, everything from hi on
+        # starts after end.
+        lo = binary_search(self._maxEnds, start + 1)
+        hi = start_bisect_left(self._items, _StartBoundary(end), lo)
+        return [item for item in self._items[lo:hi] if item.end > start]
+
+    def _updateMaxEnds(self):
+        if self._dirtyFrom >= len(self._items):
+            del self._maxEnds[len(self._items):]
+            return
+
+        del self._maxEnds[self._dirtyFrom:]
+        if self._maxEnds:
+            max_end = self._maxEnds[-1]
+        else:
+            max_end = 0
+        for item in self._items[self._dirtyFrom:]:
+            max_end = max(max_end, item.end)
+            self._maxEnds.append(max_end)
+        self._dirtyFrom = len(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+
 class Infinity(object):
     def __cmp__(self, other):
         if isinstance(other, Infinity):
@@ -0,0 +1,1624 @@
+# PiTiVi , Non-linear video editor
+#
+#       pitivi/timeline/previewers.py
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the
+# Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""
+What the previewers of the timeline are made from: the decoding and
+caching of video thumbnails and audio peaks, and the textures the
+thumbnails are drawn from.
+"""
+
+from gi.repository import Gst
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
+from gi.repository import Cogl
+
+import array
+import audioop
+import collections
+import heapq
+import itertools
+import math
+import mmap
+import os
+import sqlite3
+import string
+import struct
+import weakref
+import zlib
+import xdg.BaseDirectory as xdg_dirs
+
+from misc import FingerprintIndex
+
+# CONSTANTS
+
+# The width and height of the textures of ThumbnailTextureAtlas
+ATLAS_SIZE = 2048
+# Whether cached thumbnails are kept in memory-mapped files instead of sqlite,
+# see MmapThumbnailStore
+USE_MMAP_THUMBNAIL_STORE = False
+# Audio is decoded at this rate to compute its waveform
+WAVEFORM_RATE = 44100
+# The number of samples summarized by each peak of the finest waveform level
+WAVEFORM_WINDOW = 256
+# Each waveform level has this many times fewer peaks than the previous one
+WAVEFORM_DECIMATION = 16
+WAVEFORM_LEVELS = 4
+
+
+class Peaks(object):
+    """
+    The waveform of a media file, as WAVEFORM_LEVELS levels of peaks.
+
+    Each level is an array of signed 16 bits (min, max, rms) triples, each
+    triple summarizing a window of samples at WAVEFORM_RATE. The windows
+    of the finest level are WAVEFORM_WINDOW samples long and each level
+    has WAVEFORM_DECIMATION times longer windows than the previous one.
+
+    Saved as a header followed by the arrays, in the byte order of the
+    machine, since it is only a cache.
+    """
+
+    MAGIC = "PKS1"
+    # magic, rate, window, decimation, number of levels
+    HEADER = struct.Struct("<4sIIII")
+
+    def __init__(self, levels):
+        """
+        @param levels : the arrays of the levels, the finest first.
+        """
+        self.levels = levels
+
+    def getWindow(self, level):
+        return WAVEFORM_WINDOW * WAVEFORM_DECIMATION ** level
+
+    def getLevel(self, samples_per_pixel):
+        """
+        @returns: the finest level having at most a peak per pixel, so that
+        painting costs at most a rectangle per pixel.
+        """
+        level = 0
+        while level + 1 < len(self.levels) and \
+                self.getWindow(level) < samples_per_pixel:
+            level += 1
+        return level
+
+    def save(self, path):
+        # Never leave a truncated file behind
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(self.HEADER.pack(self.MAGIC, WAVEFORM_RATE, WAVEFORM_WINDOW,
+                                        WAVEFORM_DECIMATION, len(self.levels)))
+            file.write(struct.pack("<%dI" % len(self.levels),
+                                   *[len(values) for values in self.levels]))
+            for values in self.levels:
+                values.tofile(file)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        @returns: the Peaks saved at path, None if they can't be used.
+        """
+        with open(path, "rb") as file:
+            header = file.read(cls.HEADER.size)
+            if len(header) < cls.HEADER.size:
+                return None
+            magic, rate, window, decimation, count = cls.HEADER.unpack(header)
+            if (magic, rate, window, decimation, count) != \
+                    (cls.MAGIC, WAVEFORM_RATE, WAVEFORM_WINDOW, WAVEFORM_DECIMATION, WAVEFORM_LEVELS):
+                return None
+
+            data = file.read(4 * count)
+            if len(data) < 4 * count:
+                return None
+            sizes = struct.unpack("<%dI" % count, data)
+            levels = []
+            try:
+                for size in sizes:
+                    values = array.array("h")
+                    values.fromfile(file, size)
+                    levels.append(values)
+            except EOFError:
+                return None
+
+        return cls(levels)
+
+    @staticmethod
+    def decimate(values):
+        """
+        @returns: the triples of the next level summarizing values.
+        """
+        result = array.array("h")
+        step = 3 * WAVEFORM_DECIMATION
+        for i in xrange(0, len(values), step):
+            group = values[i:i + step]
+            rms = group[2::3]
+            result.append(min(group[0::3]))
+            result.append(max(group[1::3]))
+            result.append(int(math.sqrt(sum(r * r for r in rms) / len(rms))))
+        return result
+
+
+class PeakGenerator(object):
+    """
+    Decodes the audio of a uri once, in a background pipeline, and
+    summarizes it as the levels of L{Peaks} while it goes, so that the
+    main thread has nothing left to compute.
+
+    The samples are only looked at a buffer at a time, by audioop.
+    """
+
+    def __init__(self, uri, finishedCb):
+        """
+        @param finishedCb : called from the main thread with the generator
+        and the Peaks, None on errors.
+        """
+        self.uri = uri
+        self._finishedCb = finishedCb
+        self._levels = [array.array("h") for unused_level in xrange(WAVEFORM_LEVELS)]
+        # the number of triples of each level already summarized in the next
+        self._summarized = [0] * (WAVEFORM_LEVELS - 1)
+        # the samples not making a whole window yet
+        self._remainder = ""
+
+        self.pipeline = Gst.parse_launch("uridecodebin name=decodebin caps=audio/x-raw"
+            " ! audioconvert ! audioresample"
+            " ! audio/x-raw,format=S16LE,channels=1,rate=%d"
+            " ! appsink name=sink sync=false emit-signals=true" % WAVEFORM_RATE)
+        self.pipeline.get_by_name("decodebin").props.uri = uri
+        self.pipeline.get_by_name("sink").connect("new-sample", self._newSampleCb)
+
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message", self._busMessageCb)
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def _summarize(self, final=False):
+        """
+        Decimates the triples of each level making whole windows of the
+        next one, or all of them if final.
+        """
+        for level in xrange(WAVEFORM_LEVELS - 1):
+            values = self._levels[level]
+            start = 3 * self._summarized[level]
+            end = len(values)
+            if not final:
+                end -= (end - start) % (3 * WAVEFORM_DECIMATION)
+            if end > start:
+                self._levels[level + 1].extend(Peaks.decimate(values[start:end]))
+                self._summarized[level] = end // 3
+
+    def _finish(self, peaks):
+        self.pipeline.get_bus().remove_signal_watch()
+        self.pipeline.set_state(Gst.State.NULL)
+        self._finishedCb(self, peaks)
+
+    # Callbacks
+
+    def _newSampleCb(self, sink):
+        # Called from the streaming thread
+        buf = sink.emit("pull-sample").get_buffer()
+        data = self._remainder + buf.extract_dup(0, buf.get_size())
+
+        size = 2 * WAVEFORM_WINDOW
+        end = len(data) - len(data) % size
+        values = self._levels[0]
+        for offset in xrange(0, end, size):
+            window = buffer(data, offset, size)
+            values.extend(audioop.minmax(window, 2))
+            # A full scale square wave would overflow
+            values.append(min(audioop.rms(window, 2), 32767))
+        self._remainder = data[end:]
+        self._summarize()
+        return Gst.FlowReturn.OK
+
+    def _busMessageCb(self, unused_bus, message):
+        if message.type == Gst.MessageType.EOS:
+            # Only the last partial windows are left
+            self._summarize(final=True)
+            self._finish(Peaks(self._levels))
+        elif message.type == Gst.MessageType.ERROR:
+            self._finish(None)
+
+
+class PeakService(object):
+    """
+    Singleton handing out the L{Peaks} of media files, from the disk cache
+    or from a L{PeakGenerator}, so that they are only computed once.
+
+    At most max_generators files are decoded at the same time, the others
+    wait in line.
+    """
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        """
+        Override the new method to return the singleton instance if available.
+        Otherwise, create one.
+        """
+        if not cls._instance:
+            cls._instance = super(PeakService, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self, max_generators=2):
+        if hasattr(self, "_peaks"):
+            # Already initialized singleton
+            return
+
+        self.max_generators = max_generators
+
+        cache_dir = get_cache_dir()
+        self._dir = get_dir(os.path.join(cache_dir, "thumbs"))
+        # maps hashes to the Peaks in use
+        self._peaks = weakref.WeakValueDictionary()
+        # maps hashes to the callbacks waiting for their generator
+        self._callbacks = {}
+        # maps the running PeakGenerators to the hash of their file
+        self._generators = {}
+        # (uri, hash) of the files waiting for a generator, oldest first
+        self._waiting = collections.deque()
+
+    def requestPeaks(self, uri, callback):
+        """
+        Calls callback with the Peaks of uri as soon as they are available.
+        Nothing is called if they can't be computed.
+        """
+        hash = ThumbnailCacheManager().getHash(uri)
+        peaks = self._peaks.get(hash)
+        if peaks is None:
+            path = self._getPath(hash)
+            if os.path.exists(path):
+                peaks = Peaks.load(path)
+                if peaks is not None:
+                    self._peaks[hash] = peaks
+        if peaks is not None:
+            callback(peaks)
+            return
+
+        if hash not in self._callbacks:
+            self._callbacks[hash] = []
+            self._waiting.append((uri, hash))
+            self._startGenerators()
+        self._callbacks[hash].append(callback)
+
+    def _getPath(self, hash):
+        return os.path.join(self._dir, hash + ".peaks")
+
+    def _startGenerators(self):
+        while self._waiting and len(self._generators) < self.max_generators:
+            uri, hash = self._waiting.popleft()
+            generator = PeakGenerator(uri, self._generatorFinishedCb)
+            self._generators[generator] = hash
+
+    # Callbacks
+
+    def _generatorFinishedCb(self, generator, peaks):
+        hash = self._generators.pop(generator)
+        self._startGenerators()
+        callbacks = self._callbacks.pop(hash, [])
+        if peaks is None:
+            return
+
+        peaks.save(self._getPath(hash))
+        self._peaks[hash] = peaks
+        for callback in callbacks:
+            callback(peaks)
+
+
+class ThumbnailJob(object):
+    """
+    A request for the thumbnail of uri at timestamp, see L{ThumbnailService}.
+
+    position is where the thumbnail shows up in the timeline, requests are
+    ordered by its distance to the viewport and the playhead, refinement
+    requests coming last.
+
+    Jobs with a stop and a step decode every step from timestamp to stop
+    in a single pass.
+
+    Jobs can be shared by several requesters, each of them only being
+    called back for the timestamps it asked for. The job is cancelled once
+    all of them cancelled it.
+    """
+    __slots__ = ("uri", "timestamp", "callbacks", "position", "accurate",
+                 "refine", "stop", "step", "cancelled")
+
+    def __init__(self, uri, timestamp, position, accurate, refine,
+                 stop=None, step=None):
+        self.uri = uri
+        self.timestamp = timestamp
+        # maps timestamps to the callbacks waiting for them
+        self.callbacks = {}
+        self.position = position
+        self.accurate = accurate
+        self.refine = refine
+        self.stop = stop
+        self.step = step
+        self.cancelled = False
+
+    def getTimestamps(self):
+        if self.step is None:
+            return [self.timestamp]
+        return range(self.timestamp, self.stop, self.step)
+
+    def addCallback(self, callback, timestamps):
+        for timestamp in timestamps:
+            self.callbacks.setdefault(timestamp, []).append(callback)
+
+    def removeCallback(self, callback):
+        """
+        @returns: whether other requesters are still waiting for the job.
+        """
+        for timestamp, callbacks in self.callbacks.items():
+            callbacks[:] = [other for other in callbacks if other != callback]
+            if not callbacks:
+                del self.callbacks[timestamp]
+        return bool(self.callbacks)
+
+    def canServe(self, accurate, refine):
+        """
+        @returns: whether the job fulfills a request with these parameters.
+        """
+        return not self.cancelled and (self.accurate or not accurate) and \
+            (refine or not self.refine)
+
+    def notify(self, gdkpixbuf, timestamp):
+        for callback in list(self.callbacks.get(timestamp, ())):
+            callback(gdkpixbuf, timestamp)
+
+
+class ThumbnailDecoder(object):
+    """
+    Decodes thumbnails of a single uri, one job at a time.
+
+    It is a pipeline of the form "playbin ! thumbnailsink" where
+    thumbnailsink is a Bin made out of "capsfilter ! gdkpixbufsink"
+
+    Single thumbnails are decoded by seeking in PAUSED, ranges by playing
+    the segment once, as fast as possible, and letting only the frames
+    we are interested in through.
+    """
+
+    def __init__(self, uri, prerolledCb, frameCb, finishedCb):
+        """
+        @param prerolledCb : called with the decoder once it is prerolled,
+        or failed to.
+        @param frameCb : called with the decoder, a pixbuf and its timestamp
+        for each thumbnail of the current job.
+        @param finishedCb : called with the decoder and whether the current
+        job succeeded once it is done.
+        """
+        self.uri = uri
+        self.job = None
+        # where the last seek actually ended up
+        self.position = None
+        self.prerolled = False
+        # (width, height) of the video, known once prerolled
+        self.video_size = None
+        self.frame_duration = None
+        # the timestamps of the current job which got a thumbnail
+        self.delivered = set()
+        self._prerolledCb = prerolledCb
+        self._frameCb = frameCb
+        self._finishedCb = finishedCb
+
+        # Lists of the timestamps each frame let through while decoding a
+        # range stands for, filled from the streaming thread.
+        self._slots = collections.deque()
+        self._nextSlot = None
+
+        self.pipeline = Gst.ElementFactory.make("playbin", None)
+        self.pipeline.props.uri = uri
+        self.pipeline.props.flags = 1 # Only render video
+
+        # Set up the thumbnailsink
+        thumbnailsink = Gst.parse_bin_from_description("capsfilter caps=video/x-raw,format=(string)RGB,pixel-aspect-ratio=(fraction)1/1 ! gdkpixbufsink name=gdkpixbufsink", True)
+
+        # get the gdkpixbufsink and the automatically created ghostpad
+        self.gdkpixbufsink = thumbnailsink.get_by_name("gdkpixbufsink")
+        # Decode ranges as fast as we can
+        self.gdkpixbufsink.props.sync = False
+        self.sinkpad = thumbnailsink.get_static_pad("sink")
+        self.sinkpad.add_probe(Gst.PadProbeType.BUFFER, self._bufferProbeCb)
+
+        # Connect the playbin and the thumbnailsink
+        self.pipeline.props.video_sink = thumbnailsink
+
+        # add a message handler that listens for the created pixbufs
+        self.pipeline.get_bus().add_signal_watch()
+        self.pipeline.get_bus().connect("message", self._busMessageCb)
+
+        # Prerolling happens asynchronously, see _busMessageCb
+        self.pipeline.set_state(Gst.State.PAUSED)
+
+    def isIdle(self):
+        return self.prerolled and self.job is None
+
+    def start(self, job):
+        self.job = job
+        self.delivered = set()
+        if job.step is not None:
+            return self._startRange(job)
+
+        if job.accurate:
+            flags = Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE
+        else:
+            flags = Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT | Gst.SeekFlags.SNAP_NEAREST
+        return self.pipeline.seek(1.0,
+            Gst.Format.TIME, flags,
+            Gst.SeekType.SET, job.timestamp,
+            Gst.SeekType.NONE, -1)
+
+    def release(self):
+        self.pipeline.get_bus().remove_signal_watch()
+        self.pipeline.set_state(Gst.State.NULL)
+
+    def _startRange(self, job):
+        self._slots.clear()
+        self._nextSlot = job.timestamp
+        if not self.pipeline.seek(1.0,
+                Gst.Format.TIME, Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
+                Gst.SeekType.SET, job.timestamp,
+                Gst.SeekType.SET, job.stop):
+            return False
+        self.pipeline.set_state(Gst.State.PLAYING)
+        return True
+
+    def _finishJob(self, success):
+        if self.job.step is not None:
+            self.pipeline.set_state(Gst.State.PAUSED)
+        self._finishedCb(self, success)
+
+    def _bufferProbeCb(self, unused_pad, info):
+        # Called from the streaming thread
+        job = self.job
+        if job is None or job.step is None:
+            return Gst.PadProbeReturn.OK
+
+        buf = info.get_buffer()
+        duration = buf.duration
+        if duration == Gst.CLOCK_TIME_NONE:
+            duration = self.frame_duration or 1
+
+        # The frame stands for every slot until it ends, so that none is
+        # left empty when frames are further apart than slots.
+        slots = []
+        end = min(buf.pts + duration, job.stop)
+        while self._nextSlot < end:
+            slots.append(self._nextSlot)
+            self._nextSlot += job.step
+        if not slots:
+            return Gst.PadProbeReturn.DROP
+        self._slots.append(slots)
+        return Gst.PadProbeReturn.OK
+
+    def _busMessageCb(self, unused_bus, message):
+        # The signal watch already runs in the main thread. Messages have to
+        # be handled in order, so the preroll pixbuf isn't mistaken for the
+        # one of the job started once prerolled.
+        if message.type == Gst.MessageType.ELEMENT and \
+                message.src == self.gdkpixbufsink:
+            struct = message.get_structure()
+            job = self.job
+            if job is None:
+                # Preroll pixbuf
+                return
+
+            if job.step is None:
+                # The timestamp of the buffer isn't part of the message, the
+                # job tells us which thumbnail this is.
+                res, position = self.pipeline.query_position(Gst.Format.TIME)
+                if res:
+                    self.position = position
+                else:
+                    self.position = None
+                self.delivered.add(job.timestamp)
+                self._frameCb(self, struct.get_value("pixbuf"), job.timestamp)
+                self._finishJob(True)
+            elif struct.get_name() == "pixbuf" and self._slots:
+                # Frames get prerolled then rendered, only count them once.
+                pixbuf = struct.get_value("pixbuf")
+                for slot in self._slots.popleft():
+                    self.delivered.add(slot)
+                    self._frameCb(self, pixbuf, slot)
+        elif message.type == Gst.MessageType.EOS:
+            if self.job is not None:
+                self._finishJob(True)
+        elif message.type == Gst.MessageType.ASYNC_DONE and not self.prerolled:
+            # We can now check the width that the thumbnails will have and
+            # set the aspect ratio accordingly.
+            self.prerolled = True
+            neg_caps = self.sinkpad.get_current_caps()
+            if neg_caps:
+                structure = neg_caps[0]
+                self.video_size = structure["width"], structure["height"]
+                res, num, denom = structure.get_fraction("framerate")
+                if res and num:
+                    self.frame_duration = Gst.SECOND * denom / num
+            self._prerolledCb(self)
+        elif message.type == Gst.MessageType.ERROR:
+            if not self.prerolled:
+                self.prerolled = True
+                self._prerolledCb(self)
+            elif self.job is not None:
+                self._finishJob(False)
+
+
+class ThumbnailService(object):
+    """
+    Singleton pool of thumbnail decoders, shared by all the VideoPreviewers.
+
+    Requests from every previewer are queued per uri by their distance to
+    the viewport then to the playhead, and the most urgent ones are
+    dispatched to at most max_decoders pipelines.
+    Decoders are kept per uri and the least recently used idle one is
+    recycled when another uri needs decoding.
+    Requests for a thumbnail which is already queued or being decoded, for
+    example by another clip of the same file, share the same job.
+    """
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        """
+        Override the new method to return the singleton instance if available.
+        Otherwise, create one.
+        """
+        if not cls._instance:
+            cls._instance = super(ThumbnailService, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self, max_decoders=2):
+        if hasattr(self, "queues"):
+            # Already initialized singleton
+            return
+
+        self.max_decoders = max_decoders
+        # maps uris to heaps of (priority, serial, ThumbnailJob), cancelled
+        # jobs are removed lazily.
+        self.queues = {}
+        self._serial = itertools.count()
+        # maps (uri, timestamp) to the single thumbnail jobs in flight
+        self._inflight = {}
+        # maps uris to ThumbnailDecoders, least recently used first
+        self._decoders = collections.OrderedDict()
+        # maps uris to their video size, None if they can't be decoded
+        self._videoSizes = {}
+        self._videoSizeCallbacks = {}
+        # uris waiting for a free decoder to be probed, oldest first
+        self._probes = []
+
+        # The visible range of the timeline and the playhead position
+        self._focus = (0, 0)
+        self._playhead = 0
+        self._reprioritize = False
+        self._focusChangedId = None
+        self._previewers = weakref.WeakSet()
+        self._idleId = None
+
+        # maps uris to the estimated distance between their keyframes
+        self._keyframeIntervals = {}
+        self._frameDurations = {}
+
+    # Public API
+
+    def request(self, uri, timestamp, callback, position=0, accurate=True, refine=False):
+        """
+        Queues the decoding of the frame of uri at timestamp.
+
+        @param callback : called with the pixbuf (None on errors) and
+        timestamp from the main thread.
+        @param position : where the thumbnail is in the timeline.
+        @param accurate : False to get the nearest keyframe instead.
+        @param refine : whether this replaces an approximate thumbnail,
+        which is less urgent than anything else.
+        @returns: the ThumbnailJob, which can be cancelled.
+        """
+        job = self._inflight.get((uri, timestamp))
+        if job is not None and job.canServe(accurate, refine):
+            job.addCallback(callback, [timestamp])
+            return job
+
+        job = ThumbnailJob(uri, timestamp, position, accurate or refine, refine)
+        job.addCallback(callback, [timestamp])
+        self._inflight[(uri, timestamp)] = job
+        self._queueJob(job)
+        return job
+
+    def requestRange(self, uri, start, stop, step, callback, position=0):
+        """
+        Queues the decoding of the frames of uri every step from start to
+        stop, in a single pass. The frames already being decoded, for
+        example by another clip of the same file, are not decoded again.
+
+        @param callback : called for each of them, as for L{request}.
+        @param position : where start is in the timeline.
+        @returns: a dict mapping the timestamps to the ThumbnailJobs
+        decoding them, which can be cancelled.
+        """
+        jobs = {}
+        missing = []
+        for timestamp in xrange(start, stop, step):
+            job = self._inflight.get((uri, timestamp))
+            if job is not None and job.canServe(True, False):
+                job.addCallback(callback, [timestamp])
+                jobs[timestamp] = job
+            else:
+                missing.append(timestamp)
+        if not missing:
+            return jobs
+
+        # Still a single pass, even if other jobs have some frames in between
+        job = ThumbnailJob(uri, missing[0], position + missing[0] - start,
+                           True, False, missing[-1] + step, step)
+        job.addCallback(callback, missing)
+        for timestamp in missing:
+            self._inflight[(uri, timestamp)] = job
+            jobs[timestamp] = job
+        self._queueJob(job)
+        return jobs
+
+    def cancel(self, job, callback):
+        """
+        Drops a pending request, callback won't be called by job anymore.
+        The job keeps going if other requesters still wait for it.
+        """
+        if not job.removeCallback(callback):
+            job.cancelled = True
+            self._forgetJob(job)
+
+    def addPreviewer(self, previewer):
+        """
+        Registers a previewer to be told when the focus changes, see
+        L{VideoPreviewer.focusChanged}. Only a weak reference is kept.
+        """
+        self._previewers.add(previewer)
+
+    def setFocus(self, start, end):
+        """
+        @param start, end : the visible range of the timeline.
+        """
+        if (start, end) == self._focus:
+            return
+
+        self._focus = (start, end)
+        self._reprioritize = True
+        # Don't bother previewers for every single scroll event
+        if self._focusChangedId is None:
+            self._focusChangedId = GLib.timeout_add(100, self._focusChangedCb)
+
+    def setPlayhead(self, position):
+        self._playhead = position
+        self._reprioritize = True
+
+    def getKeyframeInterval(self, uri):
+        """
+        @returns: the estimated distance between the keyframes of uri,
+        None if no keyframe seek happened yet.
+        """
+        return self._keyframeIntervals.get(uri)
+
+    def getFrameDuration(self, uri):
+        """
+        @returns: the duration of a frame of uri, None if unknown.
+        """
+        return self._frameDurations.get(uri)
+
+    def getFocus(self):
+        """
+        @returns: the (start, end) visible range of the timeline.
+        """
+        return self._focus
+
+    def getHorizon(self):
+        """
+        @returns: the (start, end) range of the timeline worth decoding
+        thumbnails for, a page around the visible range.
+        """
+        start, end = self._focus
+        width = end - start
+        return start - width, end + width
+
+    def requestVideoSize(self, uri, callback):
+        """
+        Calls callback with the (width, height) of the video of uri, or None
+        if it can't be decoded, as soon as it is known. Never blocks.
+        """
+        if uri in self._videoSizes:
+            callback(self._videoSizes[uri])
+            return
+
+        self._videoSizeCallbacks.setdefault(uri, []).append(callback)
+        if uri not in self._decoders and uri not in self._probes:
+            self._probes.append(uri)
+            self._startProbes()
+
+    def cancelVideoSize(self, uri, callback):
+        """
+        Drops a request of L{requestVideoSize}.
+        """
+        callbacks = self._videoSizeCallbacks.get(uri, [])
+        callbacks[:] = [other for other in callbacks if other != callback]
+        if not callbacks:
+            self._videoSizeCallbacks.pop(uri, None)
+            if uri in self._probes:
+                self._probes.remove(uri)
+
+    # Internal API
+
+    def _queueJob(self, job):
+        if job.uri in self._videoSizes and self._videoSizes[job.uri] is None:
+            self._failJob(job)
+            return
+
+        queue = self.queues.setdefault(job.uri, [])
+        heapq.heappush(queue, (self._getPriority(job), next(self._serial), job))
+        self._dispatch()
+
+    def _failJob(self, job, delivered=()):
+        self._forgetJob(job)
+        timestamps = [timestamp for timestamp in job.getTimestamps()
+                      if timestamp not in delivered]
+        # It can fail from request() already, before the requester knows
+        # about the job.
+        GLib.idle_add(self._jobFailedCb, job, timestamps)
+
+    def _forgetJob(self, job, timestamps=None):
+        """
+        Stops sharing job for timestamps, all of its timestamps by default.
+        """
+        if timestamps is None:
+            timestamps = job.getTimestamps()
+        for timestamp in timestamps:
+            key = (job.uri, timestamp)
+            if self._inflight.get(key) is job:
+                del self._inflight[key]
+
+    def _getPriority(self, job):
+        position = job.position
+        start, end = self._focus
+        if position < start:
+            distance = start - position
+        elif position > end:
+            distance = position - end
+        else:
+            distance = 0
+        return job.refine, distance, abs(position - self._playhead)
+
+    def _reprioritizeQueues(self):
+        self._reprioritize = False
+        for uri, queue in self.queues.items():
+            queue[:] = [(self._getPriority(job), serial, job)
+                        for unused_priority, serial, job in queue if not job.cancelled]
+            if queue:
+                heapq.heapify(queue)
+            else:
+                del self.queues[uri]
+
+    def _makeRoom(self):
+        """
+        Makes sure a new decoder can be added to the pool.
+
+        @returns: False if the pool is full of busy decoders.
+        """
+        if len(self._decoders) < self.max_decoders:
+            return True
+
+        for uri, decoder in self._decoders.iteritems():
+            if decoder.isIdle():
+                del self._decoders[uri]
+                decoder.release()
+                return True
+        return False
+
+    def _trim(self):
+        while len(self._decoders) > self.max_decoders and self._makeRoom():
+            pass
+
+    def _createDecoder(self, uri):
+        return ThumbnailDecoder(uri, self._decoderPrerolledCb,
+                                self._decoderFrameCb, self._decoderFinishedCb)
+
+    def _getDecoder(self, uri):
+        decoder = self._decoders.pop(uri, None)
+        if decoder is None:
+            self._makeRoom()
+            decoder = self._createDecoder(uri)
+        # Mark it as the most recently used one
+        self._decoders[uri] = decoder
+        return decoder
+
+    def _hasRoom(self):
+        if len(self._decoders) < self.max_decoders:
+            return True
+        for decoder in self._decoders.itervalues():
+            if decoder.isIdle():
+                return True
+        return False
+
+    def _startProbes(self):
+        """
+        Creates decoders for the uris waiting to be probed, as long as
+        there is room in the pool.
+        """
+        while self._probes and self._hasRoom():
+            uri = self._probes.pop(0)
+            if uri not in self._decoders:
+                self._makeRoom()
+                self._decoders[uri] = self._createDecoder(uri)
+
+    def _nextUri(self):
+        """
+        @returns: the uri having the most urgent request among the ones
+        which can be decoded right now, None if there is none.
+        """
+        if self._reprioritize:
+            self._reprioritizeQueues()
+
+        best = None
+        hasRoom = self._hasRoom()
+        for uri, queue in self.queues.items():
+            while queue and queue[0][2].cancelled:
+                heapq.heappop(queue)
+            if not queue:
+                del self.queues[uri]
+                continue
+
+            decoder = self._decoders.get(uri)
+            if decoder is None and not hasRoom:
+                continue
+            if decoder is not None and not decoder.isIdle():
+                continue
+            if best is None or queue[0] < self.queues[best][0]:
+                best = uri
+        return best
+
+    def _dispatch(self):
+        uri = self._nextUri()
+        while uri is not None:
+            decoder = self._getDecoder(uri)
+            if decoder.prerolled:
+                queue = self.queues[uri]
+                job = heapq.heappop(queue)[2]
+                if not queue:
+                    del self.queues[uri]
+
+                if not decoder.start(job):
+                    decoder.job = None
+                    self._failJob(job)
+            # else _decoderPrerolledCb will dispatch again
+            uri = self._nextUri()
+        self._startProbes()
+        self._trim()
+
+        if not self.queues and not self._probes and self._idleId is None and \
+                all(decoder.job is None for decoder in self._decoders.itervalues()):
+            self._idleId = GLib.idle_add(self._idleCb)
+
+    def _updateKeyframeInterval(self, job, position):
+        # Snapping to the nearest keyframe moves the seek by up to half the
+        # interval between keyframes.
+        interval = 2 * abs(position - job.timestamp)
+        if interval > self._keyframeIntervals.get(job.uri, 0):
+            self._keyframeIntervals[job.uri] = interval
+
+    # Callbacks
+
+    def _decoderPrerolledCb(self, decoder):
+        uri = decoder.uri
+        self._videoSizes[uri] = decoder.video_size
+        if decoder.frame_duration is not None:
+            self._frameDurations[uri] = decoder.frame_duration
+        for callback in self._videoSizeCallbacks.pop(uri, []):
+            callback(decoder.video_size)
+
+        if decoder.video_size is None:
+            # Nothing to expect from this uri
+            if self._decoders.get(uri) is decoder:
+                del self._decoders[uri]
+            decoder.release()
+            for unused_priority, unused_serial, job in self.queues.pop(uri, []):
+                if not job.cancelled:
+                    self._failJob(job)
+
+        self._dispatch()
+
+    def _jobFailedCb(self, job, timestamps):
+        for timestamp in timestamps:
+            job.notify(None, timestamp)
+        return False
+
+    def _focusChangedCb(self):
+        self._focusChangedId = None
+        for previewer in list(self._previewers):
+            previewer.focusChanged()
+        self._dispatch()
+        return False
+
+    def _idleCb(self):
+        self._idleId = None
+        for previewer in list(self._previewers):
+            previewer.refine()
+        return False
+
+    def _decoderFrameCb(self, decoder, gdkpixbuf, timestamp):
+        job = decoder.job
+        if not job.accurate and decoder.position is not None:
+            self._updateKeyframeInterval(job, decoder.position)
+        # Later requests will find it in the cache
+        self._forgetJob(job, [timestamp])
+        job.notify(gdkpixbuf, timestamp)
+
+    def _decoderFinishedCb(self, decoder, success):
+        job = decoder.job
+        decoder.job = None
+        if not success and self._decoders.get(decoder.uri) is decoder:
+            del self._decoders[decoder.uri]
+            decoder.release()
+
+        # Whatever couldn't be decoded, such as a range going past the end
+        self._failJob(job, decoder.delivered)
+        self._dispatch()
+
+
+class ThumbnailTextureAtlas(object):
+
+    """A texture shared by the previewers of a media file, holding the
+    thumbnails of a given size in a grid of cells. When it is full, the
+    cell drawn the longest time ago is reused.
+
+    Cells belong to owners, which are told with their evicted() method
+    when they lose it."""
+
+    # maps (hash, width, height) to the ThumbnailTextureAtlases in use
+    _atlases = weakref.WeakValueDictionary()
+
+    @classmethod
+    def get(cls, hash, width, height):
+        """
+        @returns: the atlas for thumbnails of the given size of the media
+        file having hash.
+        """
+        atlas = cls._atlases.get((hash, width, height))
+        if atlas is None:
+            atlas = cls(width, height)
+            cls._atlases[(hash, width, height)] = atlas
+        return atlas
+
+    def __init__(self, width, height):
+        object.__init__(self)
+        self.width = width
+        self.height = height
+        self.columns = ATLAS_SIZE // width
+        self.capacity = self.columns * (ATLAS_SIZE // height)
+        # Created once there is something to show, the GL context exists then
+        self.texture = None
+        # maps owners to their cell, the least recently drawn first
+        self._cells = collections.OrderedDict()
+        self._free = range(self.capacity - 1, -1, -1)
+
+    def upload(self, owner, data, width, height, rowstride):
+        """
+        Copies the RGB pixels in data to the cell of owner.
+
+        @returns: False if data doesn't have the size of the cells.
+        """
+        if (width, height) != (self.width, self.height):
+            return False
+
+        cell = self._cells.pop(owner, None)
+        if cell is None:
+            cell = self._allocate()
+        self._cells[owner] = cell
+
+        if self.texture is None:
+            self.texture = Cogl.Texture.new_with_size(ATLAS_SIZE, ATLAS_SIZE,
+                Cogl.TextureFlags.NO_AUTO_MIPMAP, Cogl.PixelFormat.RGB_888)
+        x, y = self._getCellPosition(cell)
+        self.texture.set_region(0, 0, x, y, self.width, self.height,
+                                self.width, self.height,
+                                Cogl.PixelFormat.RGB_888, rowstride, data)
+        return True
+
+    def release(self, owner):
+        cell = self._cells.pop(owner, None)
+        if cell is not None:
+            self._free.append(cell)
+
+    def getTextureCoords(self, owner):
+        """
+        Marks the cell of owner as just drawn.
+
+        @returns: the (s1, t1, s2, t2) texture coordinates of the cell of
+        owner, None if it has none.
+        """
+        cell = self._cells.pop(owner, None)
+        if cell is None:
+            return None
+        self._cells[owner] = cell
+
+        x, y = self._getCellPosition(cell)
+        size = float(ATLAS_SIZE)
+        return x / size, y / size, (x + self.width) / size, (y + self.height) / size
+
+    def _allocate(self):
+        if self._free:
+            return self._free.pop()
+        owner, cell = self._cells.popitem(last=False)
+        owner.evicted()
+        return cell
+
+    def _getCellPosition(self, cell):
+        row, column = divmod(cell, self.columns)
+        return column * self.width, row * self.height
+
+
+# TODO: remove eventually
+autocreate = True
+
+# TODO: replace with pitivi.settings.get_dir
+def get_dir(path, autocreate=True):
+    if autocreate and not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+# TODO: replace with pitivi.settings.xdg_cache_home()
+def get_cache_dir():
+    return get_dir(os.path.join(xdg_dirs.xdg_cache_home, "pitivi"), autocreate)
+
+ThumbnailData = collections.namedtuple("ThumbnailData", "data width height rowstride")
+"""The RGB pixels of a thumbnail, data being a str, which PyGObject hands
+over to Cogl in a single copy."""
+
+
+def _getThumbnailData(pixbuf):
+    return ThumbnailData(pixbuf.get_pixels(), pixbuf.get_width(),
+                         pixbuf.get_height(), pixbuf.get_rowstride())
+
+
+class RawCodec(object):
+
+    """Stores the pixels as they are."""
+
+    FORMAT = 0
+
+    def encode(self, pixbuf):
+        return pixbuf.get_pixels(), pixbuf.get_rowstride()
+
+    def decode(self, blob, width, height, rowstride):
+        # sqlite hands out buffers
+        return ThumbnailData(str(blob), width, height, rowstride)
+
+
+class ZlibCodec(object):
+
+    """Compresses the pixels losslessly, favoring speed over size."""
+
+    FORMAT = 1
+
+    def __init__(self, level=1):
+        self.level = level
+
+    def encode(self, pixbuf):
+        return zlib.compress(pixbuf.get_pixels(), self.level), pixbuf.get_rowstride()
+
+    def decode(self, blob, width, height, rowstride):
+        return ThumbnailData(zlib.decompress(blob), width, height, rowstride)
+
+
+class JpegCodec(object):
+
+    """Stores the pixels as JPEG, using GdkPixbuf."""
+
+    FORMAT = 2
+
+    def __init__(self, quality=85):
+        self.quality = quality
+
+    def encode(self, pixbuf):
+        res, blob = pixbuf.save_to_bufferv("jpeg", ["quality"], [str(self.quality)])
+        # The decoded rows don't have to be as long as the original ones
+        return blob, 0
+
+    def decode(self, blob, width, height, unused_rowstride):
+        loader = GdkPixbuf.PixbufLoader.new_with_type("jpeg")
+        loader.write(bytes(blob))
+        loader.close()
+        return _getThumbnailData(loader.get_pixbuf())
+
+
+# maps the formats stored in the Format column to the codec decoding them
+CODECS = dict((codec.FORMAT, codec()) for codec in (RawCodec, ZlibCodec, JpegCodec))
+
+
+class SqliteThumbnailStore(object):
+
+    """Stores the thumbnails of a file as rows of an sqlite db, encoded by
+    codec. Rows written with a different codec can still be read."""
+
+    # Stored in the user_version of the database
+    SCHEMA_VERSION = 2
+
+    def __init__(self, path, codec=None):
+        object.__init__(self)
+        if codec is None:
+            codec = JpegCodec()
+        self.codec = codec
+        self.conn = sqlite3.connect(path)
+        self.cur = self.conn.cursor()
+        # Losing the last thumbnails on a crash is fine, blocking on fsync
+        # for each of them is not.
+        self.cur.execute("PRAGMA journal_mode = WAL")
+        self.cur.execute("PRAGMA synchronous = NORMAL")
+        self.cur.execute("PRAGMA temp_store = MEMORY")
+        self.cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'Thumbs'")
+        if self.cur.fetchone():
+            self._upgradeSchema()
+        else:
+            self._createSchema()
+
+    def load(self, key):
+        """
+        @returns: the L{ThumbnailData} stored for key, None if there is none.
+        """
+        self.cur.execute("SELECT Data, Width, Height, Stride, Format FROM Thumbs WHERE Time = ? AND Height = ?", key)
+        row = self.cur.fetchone()
+        if not row or row[4] not in CODECS:
+            return None
+        return CODECS[row[4]].decode(*row[:4])
+
+    def __contains__(self, key):
+        self.cur.execute("SELECT Time FROM Thumbs WHERE Time = ? AND Height = ?", key)
+        if self.cur.fetchone():
+            return True
+        return False
+
+    def store(self, items):
+        """
+        Writes the (key, pixbuf) items in a single transaction.
+        """
+        with self.conn:
+            #Replace if the key already existed
+            self.cur.executemany("INSERT OR REPLACE INTO Thumbs VALUES (?,?,?,?,?,?)",
+                                 itertools.starmap(self._encode, items))
+
+    def _createSchema(self):
+        with self.conn:
+            self.cur.execute("CREATE TABLE Thumbs (Time INTEGER NOT NULL,\
+                Data BLOB NOT NULL, Width INTEGER NOT NULL, Height INTEGER NOT NULL, Stride INTEGER NOT NULL,\
+                Format INTEGER NOT NULL, PRIMARY KEY (Time, Height))")
+            self.cur.execute("PRAGMA user_version = %d" % self.SCHEMA_VERSION)
+
+    def _upgradeSchema(self):
+        """
+        Migrates the databases written by older versions.
+        """
+        self.cur.execute("PRAGMA user_version")
+        version = self.cur.fetchone()[0]
+        if version == self.SCHEMA_VERSION:
+            return
+
+        with self.conn:
+            if version < 1:
+                # Everything was stored raw until then
+                self.cur.execute("ALTER TABLE Thumbs ADD COLUMN Format INTEGER NOT NULL DEFAULT %d"
+                                 % RawCodec.FORMAT)
+            if version < 2:
+                # Thumbnails of several heights can be stored for a time
+                self.cur.execute("CREATE TABLE NewThumbs (Time INTEGER NOT NULL,\
+                    Data BLOB NOT NULL, Width INTEGER NOT NULL, Height INTEGER NOT NULL, Stride INTEGER NOT NULL,\
+                    Format INTEGER NOT NULL, PRIMARY KEY (Time, Height))")
+                self.cur.execute("INSERT INTO NewThumbs SELECT Time, Data, Width, Height, Stride, Format FROM Thumbs")
+                self.cur.execute("DROP TABLE Thumbs")
+                self.cur.execute("ALTER TABLE NewThumbs RENAME TO Thumbs")
+            self.cur.execute("PRAGMA user_version = %d" % self.SCHEMA_VERSION)
+
+    def _encode(self, key, pixbuf):
+        blob, rowstride = self.codec.encode(pixbuf)
+        return (key[0], sqlite3.Binary(blob), pixbuf.get_width(), pixbuf.get_height(),
+                rowstride, self.codec.FORMAT)
+
+
+class MmapThumbnailFile(object):
+
+    """An append-only file of raw thumbnails of the same size, read through
+    mmap.
+
+    The data file is a header followed by the pixels of each thumbnail,
+    in slots of rowstride * height bytes. The index file lists the
+    timestamps of the slots, in the same order. A timestamp appended again
+    replaces the previous slot."""
+
+    MAGIC = "PTA1"
+    # magic, width, height, rowstride
+    HEADER = struct.Struct("<4sIII")
+
+    def __init__(self, path):
+        object.__init__(self)
+        self.path = path
+        self.width = None
+        self.height = None
+        self.rowstride = None
+        self.slot_size = None
+        # maps timestamps to slots
+        self._slots = {}
+        # the number of valid slots
+        self._count = 0
+        self._file = None
+        self._index = None
+        self._map = None
+        # the number of slots covered by _map
+        self._mapped = 0
+
+        if os.path.exists(path):
+            self._open()
+
+    def load(self, time):
+        """
+        @returns: the L{ThumbnailData} of time, None if there is none.
+        """
+        slot = self._slots.get(time)
+        if slot is None:
+            return None
+        return ThumbnailData(self._getPixels(slot), self.width, self.height, self.rowstride)
+
+    def __contains__(self, time):
+        return time in self._slots
+
+    def append(self, time, pixbuf):
+        """
+        @returns: False if pixbuf doesn't have the size of the thumbnails of
+        the file.
+        """
+        if self._file is None:
+            self._create(pixbuf)
+        elif (pixbuf.get_width(), pixbuf.get_height(), pixbuf.get_rowstride()) != \
+                (self.width, self.height, self.rowstride):
+            return False
+
+        # The last row of a pixbuf isn't necessarily padded
+        pixels = pixbuf.get_pixels()
+        self._file.seek(self.HEADER.size + self._count * self.slot_size)
+        self._file.write(pixels)
+        self._file.write("\0" * (self.slot_size - len(pixels)))
+        self._index.write(struct.pack("<q", time))
+        self._slots[time] = self._count
+        self._count += 1
+        return True
+
+    def clear(self):
+        """
+        Removes all the thumbnails, so that ones of another size can be
+        appended.
+        """
+        for file in (self._file, self._index):
+            if file is not None:
+                file.close()
+        for path in (self.path, self.path + ".index"):
+            if os.path.exists(path):
+                os.remove(path)
+        self.width = self.height = self.rowstride = self.slot_size = None
+        self._slots = {}
+        self._count = 0
+        self._file = self._index = self._map = None
+        self._mapped = 0
+
+    def sync(self):
+        if self._file is not None:
+            # The index must not list slots missing from the file
+            self._file.flush()
+            self._index.flush()
+
+    def _create(self, pixbuf):
+        self.width = pixbuf.get_width()
+        self.height = pixbuf.get_height()
+        self.rowstride = pixbuf.get_rowstride()
+        self.slot_size = self.rowstride * self.height
+        self._file = open(self.path, "w+b")
+        self._file.write(self.HEADER.pack(self.MAGIC, self.width, self.height, self.rowstride))
+        self._index = open(self.path + ".index", "wb")
+
+    def _open(self):
+        self._file = open(self.path, "r+b")
+        header = self._file.read(self.HEADER.size)
+        if len(header) < self.HEADER.size or \
+                self.HEADER.unpack(header)[0] != self.MAGIC:
+            # Start over
+            self._file.close()
+            self._file = None
+            return
+
+        unused_magic, self.width, self.height, self.rowstride = self.HEADER.unpack(header)
+        self.slot_size = self.rowstride * self.height
+
+        data = ""
+        if os.path.exists(self.path + ".index"):
+            with open(self.path + ".index", "rb") as index:
+                data = index.read()
+        times = struct.unpack("<%dq" % (len(data) // 8), data[:len(data) - len(data) % 8])
+
+        # Drop whatever was only partly written
+        file_size = os.fstat(self._file.fileno()).st_size
+        self._count = min(len(times), (file_size - self.HEADER.size) // self.slot_size)
+        for slot in xrange(self._count):
+            self._slots[times[slot]] = slot
+        self._file.truncate(self.HEADER.size + self._count * self.slot_size)
+        self._index = open(self.path + ".index", "r+b" if times else "wb")
+        self._index.truncate(self._count * 8)
+        self._index.seek(0, os.SEEK_END)
+
+    def _getPixels(self, slot):
+        if slot >= self._mapped:
+            self.sync()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mapped = self._count
+        start = self.HEADER.size + slot * self.slot_size
+        return self._map[start:start + self.slot_size]
+
+
+class MmapThumbnailStore(object):
+
+    """Stores the thumbnails of a file in a L{MmapThumbnailFile} per height,
+    so reading one costs no query nor decoding."""
+
+    def __init__(self, path):
+        object.__init__(self)
+        self.path = path
+        # maps heights to MmapThumbnailFiles
+        self._files = {}
+
+    def load(self, key):
+        """
+        @returns: the L{ThumbnailData} stored for key, None if there is none.
+        """
+        time, height = key
+        return self._getFile(height).load(time)
+
+    def __contains__(self, key):
+        time, height = key
+        return time in self._getFile(height)
+
+    def store(self, items):
+        """
+        Appends the (key, pixbuf) items to the files.
+        """
+        files = set()
+        for (time, height), pixbuf in items:
+            mmap_file = self._getFile(height)
+            if not mmap_file.append(time, pixbuf):
+                # Most likely thumbnails made before the size of the video
+                # was known, which the ones of the right size replace.
+                mmap_file.clear()
+                mmap_file.append(time, pixbuf)
+            files.add(mmap_file)
+        for mmap_file in files:
+            mmap_file.sync()
+
+    def _getFile(self, height):
+        mmap_file = self._files.get(height)
+        if mmap_file is None:
+            mmap_file = MmapThumbnailFile("%s-%d.mmap" % (self.path, height))
+            self._files[height] = mmap_file
+        return mmap_file
+
+
+class ThumbnailCache(object):
+
+    """Caches thumbnails by (time, height) key using LRU policy.
+
+    Uses a two stage caching mechanism. The most recently used thumbnails
+    are held in memory, up to max_bytes of pixel data, the rest is being
+    cached on disk by a store, L{SqliteThumbnailStore} by default or
+    L{MmapThumbnailStore}.
+
+    The hits, misses and evictions attributes count what happened in the
+    memory stage.
+
+    Use L{ThumbnailCacheManager} to get the one of a file.
+
+    Writes to the disk stage are buffered and flushed in a single
+    transaction every FLUSH_COUNT thumbnails or FLUSH_DELAY ms, whichever
+    comes first. Call L{flushAll} before exiting."""
+
+    FLUSH_COUNT = 64
+    FLUSH_DELAY = 300
+
+    _instances = weakref.WeakSet()
+
+    def __init__(self, hash, max_bytes=16 * 1024 * 1024, store_class=SqliteThumbnailStore):
+        object.__init__(self)
+        self._instances.add(self)
+        # maps keys to the pixbufs waiting to be written
+        self._pending = collections.OrderedDict()
+        self._flushId = None
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # maps keys to ThumbnailData, the least recently used first
+        self._memory = collections.OrderedDict()
+        self._memoryBytes = 0
+        self.hash = hash
+        cache_dir = get_cache_dir()
+        self.store = store_class(os.path.join(get_dir(os.path.join(cache_dir, "thumbs")), self.hash))
+
+    def get(self, key, default=None):
+        """
+        @returns: the L{ThumbnailData} cached for key, default if there is
+        none.
+        """
+        thumbnail_data = self._memory.pop(key, None)
+        if thumbnail_data is not None:
+            self.hits += 1
+            self._memory[key] = thumbnail_data
+            return thumbnail_data
+
+        self.misses += 1
+        pixbuf = self._pending.get(key)
+        if pixbuf is not None:
+            thumbnail_data = _getThumbnailData(pixbuf)
+        else:
+            thumbnail_data = self.store.load(key)
+            if thumbnail_data is None:
+                return default
+
+        self._remember(key, thumbnail_data)
+        return thumbnail_data
+
+    def __contains__(self, key):
+        if key in self._memory or key in self._pending:
+            return True
+        # check if item is present in on disk cache
+        return key in self.store
+
+    def __getitem__(self, key):
+        thumbnail_data = self.get(key)
+        if thumbnail_data is None:
+            raise KeyError(key)
+        return thumbnail_data
+
+    def __setitem__(self, key, value):
+        """
+        @param value: a GdkPixbuf.Pixbuf
+        """
+        self._remember(key, _getThumbnailData(value))
+        self._pending.pop(key, None)
+        self._pending[key] = value
+
+        if len(self._pending) >= self.FLUSH_COUNT:
+            self.flush()
+        elif self._flushId is None:
+            self._flushId = GLib.timeout_add(self.FLUSH_DELAY, self._flushCb)
+
+    def flush(self):
+        """
+        Writes the buffered thumbnails to disk.
+        """
+        if self._flushId is not None:
+            GLib.source_remove(self._flushId)
+            self._flushId = None
+        if not self._pending:
+            return
+
+        self.store.store(self._pending.iteritems())
+        self._pending.clear()
+
+    @classmethod
+    def flushAll(cls):
+        """
+        Writes the buffered thumbnails of every cache to disk.
+        """
+        for cache in list(cls._instances):
+            cache.flush()
+
+    def _remember(self, key, thumbnail_data):
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memoryBytes -= len(old.data)
+        self._memory[key] = thumbnail_data
+        self._memoryBytes += len(thumbnail_data.data)
+
+        # Keep at least the newest one, however big it is
+        while self._memoryBytes > self.max_bytes and len(self._memory) > 1:
+            unused_key, evicted = self._memory.popitem(last=False)
+            self._memoryBytes -= len(evicted.data)
+            self.evictions += 1
+
+    # Callbacks
+
+    def _flushCb(self):
+        self._flushId = None
+        self.flush()
+        return False
+
+
+class ThumbnailCacheManager(object):
+    """
+    Singleton handing out a single ThumbnailCache per media file, so that
+    the clips of the same file share their thumbnails and database
+    connection.
+
+    store_class is the disk stage of the caches, see L{ThumbnailCache}. By
+    default it depends on USE_MMAP_THUMBNAIL_STORE.
+    """
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        """
+        Override the new method to return the singleton instance if available.
+        Otherwise, create one.
+        """
+        if not cls._instance:
+            cls._instance = super(ThumbnailCacheManager, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self, store_class=None):
+        if hasattr(self, "_caches"):
+            # Already initialized singleton
+            return
+
+        if store_class is None:
+            if USE_MMAP_THUMBNAIL_STORE:
+                store_class = MmapThumbnailStore
+            else:
+                store_class = SqliteThumbnailStore
+        self.store_class = store_class
+        cache_dir = get_cache_dir()
+        fingerprints_path = os.path.join(cache_dir, "fingerprints")
+        if not os.path.exists(fingerprints_path):
+            self._removeOldCaches(os.path.join(cache_dir, "thumbs"))
+        self._fingerprints = FingerprintIndex(fingerprints_path)
+        # maps uris to the hash of their file
+        self._hashes = {}
+        # maps hashes to the ThumbnailCaches in use
+        self._caches = weakref.WeakValueDictionary()
+
+    def getHash(self, uri):
+        """
+        @returns: the fingerprint of the file of uri.
+        """
+        hash = self._hashes.get(uri)
+        if hash is None:
+            hash = self._fingerprints.fingerprint(Gst.uri_get_location(uri))
+            self._hashes[uri] = hash
+        return hash
+
+    def getCache(self, uri):
+        """
+        @returns: the ThumbnailCache of the file of uri.
+        """
+        hash = self.getHash(uri)
+        cache = self._caches.get(hash)
+        if cache is None:
+            cache = ThumbnailCache(hash, store_class=self.store_class)
+            self._caches[hash] = cache
+        return cache
+
+    def _removeOldCaches(self, thumbs_dir):
+        """
+        Removes the caches named after the hashes of the first 256KB of
+        their file, made before files were fingerprinted by their size,
+        head, middle and tail, which nothing will ever read again.
+        """
+        if not os.path.isdir(thumbs_dir):
+            return
+        for name in os.listdir(thumbs_dir):
+            # The sqlite databases and their journals
+            hash = name.split("-")[0]
+            if len(hash) == 64 and all(char in string.hexdigits for char in hash):
+                os.remove(os.path.join(thumbs_dir, name))
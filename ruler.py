@@ -32,7 +32,7 @@ from gi.repository import GObject
 from gettext import gettext as _
 
 from pipeline import Seeker
-from utils import Zoomable
+from utils import Zoomable, ZOOM_RULERS
 from loggable import Loggable
 from ui import time_to_string, beautify_length
 
@@ -59,7 +59,7 @@ class ScaleRuler(Gtk.DrawingArea, Zoomable, Loggable):
 
     def __init__(self, instance, hadj):
         Gtk.DrawingArea.__init__(self)
-        Zoomable.__init__(self)
+        Zoomable.__init__(self, ZOOM_RULERS)
         Loggable.__init__(self)
         self.log("Creating new ScaleRuler")
         self.app = instance
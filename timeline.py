@@ -5,11 +5,9 @@ from gi.repository import GES
 from gi.repository import GObject
 
 import collections
-import hashlib
 import os
-import sqlite3
 import sys
-import xdg.BaseDirectory as xdg_dirs
+import weakref
 
 from gi.repository import Clutter, GObject, Gtk, Cogl
 
@@ -20,6 +18,12 @@ from gi.repository import GdkPixbuf
 from viewer import ViewerWidget
 
 from utils import Zoomable, EditingContext, Selection, SELECT, UNSELECT, Selected
+from utils import ZOOM_PREVIEWERS, ZOOM_CONTROLS, CursorManager
+
+from misc import IntervalIndex
+
+from previewers import ThumbnailService, ThumbnailCache, ThumbnailCacheManager
+from previewers import ThumbnailTextureAtlas, PeakService, WAVEFORM_RATE
 
 from ruler import ScaleRuler
 
@@ -39,6 +43,18 @@ CONTROL_WIDTH = 250
 
 BORDER_WIDTH = 3 #For the timeline elements
 
+# Assumed distance between keyframes until we know better, see
+# ThumbnailService.getKeyframeInterval
+KEYFRAME_INTERVAL_GUESS = Gst.SECOND
+# Thumbnails closer than this many frames are decoded in a single pass
+SEQUENTIAL_DECODE_FRAMES = 8
+# The coarser time grids of the thumbnail pyramid, see VideoPreviewer
+THUMB_LEVELS = [Gst.SECOND, 10 * Gst.SECOND, 60 * Gst.SECOND, 600 * Gst.SECOND]
+# The number of hidden Thumbnail actors a VideoPreviewer keeps for reuse
+THUMB_POOL_SIZE = 256
+# Whether video thumbnails are drawn from shared textures, see AtlasVideoPreviewer
+USE_THUMBNAIL_ATLAS = True
+
 ZOOM_FIT = _("Zoom Fit")
 
 """
@@ -47,9 +63,36 @@ Every GES element which name could be mistaken with a UI element
 is prefixed with a little b, example : bTimeline
 """
 
+def round_rectangle_paths(width, height, arc, step, border_width):
+    """
+    @returns: the CoglPaths of the border and of the inside of a rounded
+    rectangle, to be filled as many times as needed.
+    """
+    # draw the rectangle for the border which is the same size as the
+    # object
+    Cogl.path_new()
+    Cogl.path_round_rectangle(0, 0, width, height, arc, step)
+    Cogl.path_round_rectangle(border_width, border_width,
+                              width - border_width, height - border_width,
+                              arc, step)
+    Cogl.path_set_fill_rule(Cogl.PathFillRule.EVEN_ODD)
+    Cogl.path_close()
+    border = Cogl.get_path()
+
+    # draw the content with is the same size minus the width of the border
+    Cogl.path_new()
+    Cogl.path_round_rectangle(border_width, border_width,
+                              width - border_width, height - border_width,
+                              arc, step)
+    Cogl.path_close()
+    return border, Cogl.get_path()
+
 class RoundedRectangle(Clutter.Actor):
     """
     Custom actor used to draw a rectangle that can have rounded corners
+
+    The paths are kept between paints, Cogl only tessellates them again
+    when the geometry changes.
     """
     __gtype_name__ = 'RoundedRectangle'
 
@@ -66,42 +109,40 @@ class RoundedRectangle(Clutter.Actor):
         self._border_width = border_width
         self._color = color
         self._border_color = border_color
+        # the geometry the paths were built for
+        self._pathsKey = None
+        self._borderPath = None
+        self._fillPath = None
 
     def do_paint(self):
         # Set a rectangle for the clipping
         Cogl.clip_push_rectangle(0, 0, self.props.width, self.props.height)
 
-        if self._border_color:
-            # draw the rectangle for the border which is the same size as the
-            # object
-            Cogl.path_round_rectangle(0, 0, self.props.width, self.props.height, 
-                                      self._arc, self._step)
-            Cogl.path_round_rectangle(self._border_width, self._border_width,
-                                      self.props.width - self._border_width,
-                                      self.props.height - self._border_width, 
-                                      self._arc, self._step)
-            Cogl.path_set_fill_rule(Cogl.PathFillRule.EVEN_ODD)
-            Cogl.path_close()
+        key = (self.props.width, self.props.height, self._arc, self._step,
+               self._border_width)
+        if key != self._pathsKey:
+            self._buildPaths()
+            self._pathsKey = key
 
+        if self._border_color:
             # set color to border color
             Cogl.set_source_color(self._border_color)
-            Cogl.path_fill()
+            Cogl.set_path(self._borderPath)
+            Cogl.path_fill_preserve()
 
         if self._color:
-            # draw the content with is the same size minus the width of the border
-            # finish the clip
-            Cogl.path_round_rectangle(self._border_width, self._border_width, 
-                                      self.props.width - self._border_width, 
-                                      self.props.height - self._border_width,
-                                      self._arc, self._step)
-            Cogl.path_close()
-
             # set the color of the filled area
             Cogl.set_source_color(self._color)
-            Cogl.path_fill()
+            Cogl.set_path(self._fillPath)
+            Cogl.path_fill_preserve()
         
         Cogl.clip_pop()
 
+    def _buildPaths(self):
+        self._borderPath, self._fillPath = round_rectangle_paths(
+            self.props.width, self.props.height, self._arc, self._step,
+            self._border_width)
+
     def get_color(self):
         return self._color
         
@@ -123,12 +164,21 @@ class RoundedRectangle(Clutter.Actor):
         self._border_color = color
         self.queue_redraw()
 
-class TrimHandle(Clutter.Texture):
+class TrimHandle(Clutter.Actor):
+    """
+    The images of all the handles are loaded once and shared, they are
+    switched by swapping the content of the actor.
+    """
+    # maps image names to Clutter.Images, see _getImage
+    _images = {}
+
     def __init__(self, timelineElement, isLeft):
-        Clutter.Texture.__init__(self)
-        self.set_from_file("trimbar-normal.png")
+        Clutter.Actor.__init__(self)
+        image = self._getImage("trimbar-normal.png")
+        self.props.content = image
         self.isLeft = isLeft
-        self.set_size(-1, EXPANDED_SIZE)
+        unused_res, width, unused_height = image.get_preferred_size()
+        self.set_size(width, EXPANDED_SIZE)
         self.hide()
 
         self.isSelected = False
@@ -148,7 +198,41 @@ class TrimHandle(Clutter.Texture):
         self.connect("leave-event", self._leaveEventCb)
         self.timelineElement.connect("enter-event", self._elementEnterEventCb)
         self.timelineElement.connect("leave-event", self._elementLeaveEventCb)
-        self.timelineElement.bElement.selected.connect("selected-changed", self._selectedChangedCb)
+        self._selectedId = None
+
+    @classmethod
+    def _getImage(cls, name):
+        image = cls._images.get(name)
+        if image is None:
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
+            if pixbuf.get_has_alpha():
+                pixel_format = Cogl.PixelFormat.RGBA_8888
+            else:
+                pixel_format = Cogl.PixelFormat.RGB_888
+            image = Clutter.Image.new()
+            image.set_data(pixbuf.get_pixels(), pixel_format, pixbuf.get_width(),
+                           pixbuf.get_height(), pixbuf.get_rowstride())
+            cls._images[name] = image
+        return image
+
+    # Public API
+
+    def bind(self):
+        """
+        Follows the selection state of the current bElement of our
+        timelineElement, called each time the timelineElement is bound.
+        """
+        selected = self.timelineElement.bElement.selected
+        self._selectedId = selected.connect("selected-changed", self._selectedChangedCb)
+        self._selectedChangedCb(selected, bool(selected))
+
+    def unbind(self):
+        if self._selectedId is not None:
+            self.timelineElement.bElement.selected.disconnect(self._selectedId)
+            self._selectedId = None
+        self.isSelected = False
+        self.hide()
 
     #Callbacks
 
@@ -157,18 +241,18 @@ class TrimHandle(Clutter.Texture):
         for elem in self.timelineElement.get_children():
             elem.set_reactive(False)
         self.set_reactive(True)
-        self.set_from_file("trimbar-focused.png")
+        self.props.content = self._getImage("trimbar-focused.png")
         if self.isLeft:
-            self.timelineElement.timeline._container.embed.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.LEFT_SIDE))
+            self.timelineElement.timeline.cursors.setCursor(Gdk.CursorType.LEFT_SIDE)
         else:
-            self.timelineElement.timeline._container.embed.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.RIGHT_SIDE))
+            self.timelineElement.timeline.cursors.setCursor(Gdk.CursorType.RIGHT_SIDE)
 
     def _leaveEventCb(self, actor, event):
         self.timelineElement.set_reactive(True)
         for elem in self.timelineElement.get_children():
             elem.set_reactive(True)
-        self.set_from_file("trimbar-normal.png")
-        self.timelineElement.timeline._container.embed.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.ARROW))
+        self.props.content = self._getImage("trimbar-normal.png")
+        self.timelineElement.timeline.cursors.setCursor(Gdk.CursorType.ARROW)
 
     def _elementEnterEventCb(self, actor, event):
         self.show()
@@ -219,30 +303,28 @@ class TrimHandle(Clutter.Texture):
         self.timelineElement.set_reactive(True)
         for elem in self.timelineElement.get_children():
             elem.set_reactive(True)
-        self.set_from_file("trimbar-normal.png")
-        self.timelineElement.timeline._container.embed.get_window().set_cursor(Gdk.Cursor.new(Gdk.CursorType.ARROW))
+        self.props.content = self._getImage("trimbar-normal.png")
+        self.timelineElement.timeline.cursors.setCursor(Gdk.CursorType.ARROW)
 
 
 class TimelineElement(Clutter.Actor, Zoomable):
-    def __init__(self, bElement, track, timeline):
+    def __init__(self, bElement, track, timeline, preview=None):
         """
         @param bElement : the backend GES.TrackElement
         @param track : the track to which the bElement belongs
         @param timeline : the containing graphic timeline.
+        @param preview : an already existing preview for the bElement, if any.
         """
         Zoomable.__init__(self)
         Clutter.Actor.__init__(self)
 
         self.timeline = timeline
 
-        self.bElement = bElement
-
-        self.bElement.selected = Selected()
-        self.bElement.selected.connect("selected-changed", self._selectedChangedCb)
-
-        self._createBackground(track)
+        self.bElement = None
+        self.preview = None
+        self._selectedId = None
 
-        self._createPreview()
+        self._createBackground()
 
         self._createBorder()
 
@@ -252,17 +334,60 @@ class TimelineElement(Clutter.Actor, Zoomable):
 
         self._createGhostclip()
 
-        self.track_type = self.bElement.get_track_type() # This won't change
-
         self.isDragged = False
 
-        size = self.bElement.get_duration()
-        self.set_size(self.nsToPixel(size), EXPANDED_SIZE, False)
         self.set_reactive(True)
         self._connectToEvents()
 
+        self.bind(bElement, track, preview)
+
     # Public API
 
+    def bind(self, bElement, track, preview=None):
+        """
+        Makes this actor represent bElement.
+
+        Actors get recycled this way when the timeline is virtualized,
+        see L{Timeline.setVirtualized}.
+        """
+        self.bElement = bElement
+        self.track_type = self.bElement.get_track_type() # This won't change
+
+        # Before _showSelected, which can create and bind handles that
+        # don't exist yet, see CompactTimelineElement
+        self._bindHandles()
+
+        self._selectedId = self.bElement.selected.connect("selected-changed", self._selectedChangedCb)
+        self._showSelected(bool(self.bElement.selected))
+
+        self._setBackgroundColor(track)
+
+        self._createPreview(preview)
+
+        size = self.bElement.get_duration()
+        self.set_size(self.nsToPixel(size), EXPANDED_SIZE, False)
+
+    def unbind(self):
+        """
+        Detaches this actor from its bElement so it can be recycled.
+
+        @returns: the preview of the bElement, so it can be reused later on.
+        """
+        self._unbindHandles()
+
+        self.bElement.selected.disconnect(self._selectedId)
+        self._selectedId = None
+
+        preview = self.preview
+        self.remove_child(preview)
+        self.preview = None
+
+        self._showSelected(False)
+        self.ghostclip.props.visible = False
+        self.isDragged = False
+        self.bElement = None
+        return preview
+
     def set_size(self, width, height, ease):
         if ease:
             self.save_easing_state()
@@ -357,19 +482,24 @@ class TimelineElement(Clutter.Actor, Zoomable):
         self.border.set_position(0, 0)
         self.add_child(self.border)
 
-    def _createBackground(self, track):
+    def _createBackground(self):
         self.background = RoundedRectangle(0, 0, 5, 5)
+        self.background.set_border_width(3)
+
+        self.background.set_position(0, 0)
+        self.add_child(self.background)
+
+    def _setBackgroundColor(self, track):
+        self.background.set_color(self._getBackgroundColor(track))
+
+    def _getBackgroundColor(self, track):
         if track.type == GES.TrackType.AUDIO:
             color = Cogl.Color()
             color.init_from_4ub(70, 79, 118, 255)
         else:
             color = Cogl.Color()
             color.init_from_4ub(225, 232, 238, 255)
-        self.background.set_color(color)
-        self.background.set_border_width(3)
-
-        self.background.set_position(0, 0)
-        self.add_child(self.background)
+        return color
 
     def _createHandles(self):
         self.leftHandle = TrimHandle(self, True)
@@ -378,9 +508,22 @@ class TimelineElement(Clutter.Actor, Zoomable):
         self.add_child(self.rightHandle)
         self.leftHandle.set_position(0, 0)
 
-    def _createPreview(self):
-        self.preview = get_preview_for_object(self.bElement)
-        self.add_child(self.preview)
+    def _bindHandles(self):
+        self.leftHandle.bind()
+        self.rightHandle.bind()
+
+    def _unbindHandles(self):
+        self.leftHandle.unbind()
+        self.rightHandle.unbind()
+
+    def _showSelected(self, isSelected):
+        self.marquee.props.visible = isSelected
+
+    def _createPreview(self, preview=None):
+        if preview is None:
+            preview = get_preview_for_object(self.bElement)
+        self.preview = preview
+        self.insert_child_above(self.preview, self.background)
 
     def _createMarquee(self):
         # TODO: difference between Actor.new() and Actor()?
@@ -412,7 +555,10 @@ class TimelineElement(Clutter.Actor, Zoomable):
     # Interface (Zoomable)
 
     def zoomChanged(self):
-        self.update(True)
+        # Recycled actors waiting in the pool have nothing to show.
+        if self.bElement is not None:
+            # Only bother animating what the user can see.
+            self.update(self.timeline.isElementVisible(self))
 
     # Callbacks
 
@@ -478,7 +624,177 @@ class TimelineElement(Clutter.Actor, Zoomable):
         self._context.finish()
 
     def _selectedChangedCb(self, selected, isSelected):
-        self.marquee.props.visible = isSelected
+        self._showSelected(isSelected)
+
+
+class CompactTimelineElement(TimelineElement):
+    """
+    A TimelineElement painting its background, border, selection marquee
+    and trim handle hints itself, instead of having an actor for each.
+    Its TrimHandles are only created once the pointer enters it or it gets
+    selected.
+
+    See L{Timeline.setCompact}.
+    """
+
+    def __init__(self, bElement, track, timeline, preview=None):
+        self._color = None
+        self._isSelected = False
+        # the size the paths were built for
+        self._pathsKey = None
+        self._borderPath = None
+        self._fillPath = None
+
+        self._borderColor = Cogl.Color()
+        self._borderColor.init_from_4ub(100, 100, 100, 255)
+        self._marqueeColor = Cogl.Color()
+        self._marqueeColor.init_from_4ub(60, 60, 60, 100)
+        self._marqueeColor.premultiply()
+        self._hintColor = Cogl.Color()
+        self._hintColor.init_from_4ub(160, 160, 160, 255)
+
+        TimelineElement.__init__(self, bElement, track, timeline, preview)
+        self.connect("enter-event", self._compactEnterEventCb)
+
+    def set_size(self, width, height, ease):
+        if ease:
+            self.save_easing_state()
+            self.set_easing_duration(600)
+            self.preview.save_easing_state()
+            self.preview.set_easing_duration(600)
+            if self.rightHandle is not None:
+                self.rightHandle.save_easing_state()
+                self.rightHandle.set_easing_duration(600)
+
+        self.props.width = width
+        self.props.height = height
+        self.preview.set_size(width, height)
+        if self.rightHandle is not None:
+            self.rightHandle.set_position(width - self.rightHandle.props.width, 0)
+
+        if ease:
+            self.preview.restore_easing_state()
+            if self.rightHandle is not None:
+                self.rightHandle.restore_easing_state()
+            self.restore_easing_state()
+
+    # Internal API
+
+    def _createBackground(self):
+        pass
+
+    def _createBorder(self):
+        pass
+
+    def _createMarquee(self):
+        pass
+
+    def _createHandles(self):
+        self.leftHandle = None
+        self.rightHandle = None
+
+    def _ensureHandles(self):
+        if self.leftHandle is not None:
+            return
+
+        TimelineElement._createHandles(self)
+        self.rightHandle.set_position(self.props.width - self.rightHandle.props.width, 0)
+        if self.bElement is not None:
+            TimelineElement._bindHandles(self)
+
+    def _bindHandles(self):
+        if self.leftHandle is not None:
+            TimelineElement._bindHandles(self)
+
+    def _unbindHandles(self):
+        if self.leftHandle is not None:
+            TimelineElement._unbindHandles(self)
+
+    def _showSelected(self, isSelected):
+        self._isSelected = isSelected
+        if isSelected:
+            self._ensureHandles()
+        self.queue_redraw()
+
+    def _setBackgroundColor(self, track):
+        self._color = self._getBackgroundColor(track)
+        self.queue_redraw()
+
+    def _createPreview(self, preview=None):
+        if preview is None:
+            preview = get_preview_for_object(self.bElement)
+        self.preview = preview
+        self.insert_child_at_index(self.preview, 0)
+
+    # Interface (Clutter.Actor)
+
+    def do_paint(self):
+        width = self.props.width
+        height = self.props.height
+        if (width, height) != self._pathsKey:
+            self._borderPath, self._fillPath = round_rectangle_paths(
+                width, height, 5, 5, BORDER_WIDTH)
+            self._pathsKey = (width, height)
+
+        Cogl.clip_push_rectangle(0, 0, width, height)
+
+        if self._color:
+            Cogl.set_source_color(self._color)
+            Cogl.set_path(self._fillPath)
+            Cogl.path_fill_preserve()
+
+        self.preview.paint()
+
+        Cogl.set_source_color(self._borderColor)
+        Cogl.set_path(self._borderPath)
+        Cogl.path_fill_preserve()
+
+        if self._isSelected:
+            Cogl.set_source_color(self._marqueeColor)
+            Cogl.rectangle(0, 0, width, height)
+
+        if self.leftHandle is not None and self.leftHandle.props.visible:
+            # Hidden handles don't paint anything
+            self.leftHandle.paint()
+            self.rightHandle.paint()
+        else:
+            # Tell where the handles will show up
+            Cogl.set_source_color(self._hintColor)
+            Cogl.rectangle(0, height / 3, BORDER_WIDTH, 2 * height / 3)
+            Cogl.rectangle(width - BORDER_WIDTH, height / 3, width, 2 * height / 3)
+
+        Cogl.clip_pop()
+
+    # Callbacks
+
+    def _compactEnterEventCb(self, actor, event):
+        if self.leftHandle is None:
+            self._ensureHandles()
+            # They missed the event
+            self.leftHandle.show()
+            self.rightHandle.show()
+        return False
+
+class ElementRecord(object):
+    """
+    Lightweight bookkeeping for a GES.TrackElement shown in the timeline.
+
+    The TimelineElement actor is only there while the record is realized,
+    the preview is kept around so thumbnails survive the actor being recycled.
+    start, end and layer are maintained by the timeline's interval indexes.
+    """
+    __slots__ = ("bElement", "track", "clip", "actor", "preview", "start", "end", "layer")
+
+    def __init__(self, bElement, track):
+        self.bElement = bElement
+        self.track = track
+        self.clip = bElement.get_parent()
+        self.actor = None
+        self.preview = None
+        self.start = bElement.get_start()
+        self.end = self.start + bElement.get_duration()
+        self.layer = self.clip.get_layer()
+        bElement.selected = Selected()
 
 class Timeline(Clutter.ScrollActor, Zoomable):
     def __init__(self, container):
@@ -487,10 +803,23 @@ class Timeline(Clutter.ScrollActor, Zoomable):
         self.set_background_color(Clutter.Color.new(31, 30, 33, 255))
         self.props.width = 1920
         self.props.height = 500
+        # The realized TimelineElements, see setVirtualized
         self.elements = []
+        # maps GES.TrackElements to ElementRecords
+        self.records = {}
+        # maps GES.Clips to the ElementRecords of their track elements
+        self._clipRecords = {}
+        # maps GES.TimelineLayers to IntervalIndexes of their ElementRecords
+        self._layerIndexes = {}
+        self._elementPool = []
+        self._virtualized = False
+        self._compact = False
+        # x, y, width, height of the visible area, in pixels
+        self._viewport = (0, 0, self.props.width, self.props.height)
         self.selection = Selection()
         self._createPlayhead()
         self._container = container
+        self.cursors = CursorManager(container.embed)
         self.lastPosition = 0
 
     # Public API
@@ -511,6 +840,70 @@ class Timeline(Clutter.ScrollActor, Zoomable):
         self.bTimeline.connect("layer-removed", self._layerRemovedCb)
         self.zoomChanged()
 
+    def setVirtualized(self, virtualized):
+        """
+        When virtualized, only the elements intersecting the viewport get a
+        TimelineElement, the others are only kept as records and their
+        actors are recycled as the viewport moves.
+        """
+        self._virtualized = virtualized
+        self._cullElements()
+
+    def setCompact(self, compact):
+        """
+        When compact, elements are drawn by a single CompactTimelineElement
+        actor each, see L{CompactTimelineElement}.
+        """
+        if compact == self._compact:
+            return
+
+        self._compact = compact
+        for record in self.records.itervalues():
+            if record.actor is not None:
+                self._unrealizeRecord(record)
+        # The recycled actors are of the other kind
+        for element in self._elementPool:
+            self.remove_child(element.ghostclip)
+        self._elementPool = []
+        self._cullElements()
+
+    def elementsInRange(self, startNs, endNs, layers=None):
+        """
+        @param startNs, endNs : the time range to look into.
+        @param layers : the GES.TimelineLayers to look into, all of them if None.
+        @returns: the ElementRecords overlapping the range, sorted by start
+        for each layer.
+        """
+        if layers is None:
+            indexes = self._layerIndexes.itervalues()
+        else:
+            indexes = [self._layerIndexes[layer] for layer in layers
+                       if layer in self._layerIndexes]
+
+        res = []
+        for index in indexes:
+            res.extend(index.overlapping(startNs, endNs))
+        return res
+
+    def isElementVisible(self, element):
+        """
+        @returns: whether the TimelineElement currently intersects the viewport.
+        """
+        x, y, width, height = self._viewport
+        start = self.nsToPixel(element.bElement.get_start())
+        end = start + self.nsToPixel(element.bElement.get_duration())
+        return (end >= x and start <= x + width and
+                element.props.y + EXPANDED_SIZE >= y and element.props.y <= y + height)
+
+    def setViewport(self, x, y, width, height):
+        """
+        @param x, y, width, height : the visible area, in timeline pixels.
+        """
+        self._viewport = (x, y, width, height)
+        if self._virtualized:
+            self._cullElements()
+        self._updateThumbnailFocus()
+
     #Stage was clicked with nothing under the pointer
     def emptySelection(self):
         """
@@ -519,18 +912,18 @@ class Timeline(Clutter.ScrollActor, Zoomable):
         self.selection.setSelection(self.selection.getSelectedTrackElements(), UNSELECT)
 
     def findBrother(self, element):
-        father = element.get_parent()
-        for elem in self.elements:
-            if elem.bElement.get_parent() == father and elem.bElement != element:
-                return elem
+        for record in self._clipRecords[self.records[element].clip]:
+            if record.bElement != element:
+                return record.actor
         return None
 
     #Internal API
 
     def _positionCb(self, pipeline, position):
         self.playhead.props.x = self.nsToPixel(position)
-        self._container._scrollToPlayhead()
         self.lastPosition = position
+        ThumbnailService().setPlayhead(position)
+        self._container._scrollToPlayhead()
 
     def _updatePlayHead(self):
         height = len(self.bTimeline.get_layers()) * (EXPANDED_SIZE + SPACING) * 2
@@ -545,26 +938,116 @@ class Timeline(Clutter.ScrollActor, Zoomable):
         self.playhead.set_z_position(1)
 
     def _addTimelineElement(self, track, bElement):
-        element = TimelineElement(bElement, track, self)
-        element.set_z_position(-1)
+        record = ElementRecord(bElement, track)
+        self.records[bElement] = record
+        self._clipRecords.setdefault(record.clip, []).append(record)
+        self._layerIndexes.setdefault(record.layer, IntervalIndex()).add(record)
+
+        bElement.connect("notify::start", self._elementStartChangedCb, record)
+        bElement.connect("notify::duration", self._elementDurationChangedCb, record)
+        bElement.connect("notify::in-point", self._elementInPointChangedCb, record)
+        bElement.connect("notify::priority", self._elementPriorityChangedCb, record)
 
-        bElement.connect("notify::start", self._elementStartChangedCb, element)
-        bElement.connect("notify::duration", self._elementDurationChangedCb, element)
-        bElement.connect("notify::in-point", self._elementInPointChangedCb, element)
-        bElement.connect("notify::priority", self._elementPriorityChangedCb, element)
+        if not self._virtualized or self._isInViewport(record):
+            self._realizeRecord(record)
+
+    def _removeTimelineElement(self, track, bElement):
+        bElement.disconnect_by_func(self._elementStartChangedCb)
+        bElement.disconnect_by_func(self._elementDurationChangedCb)
+        bElement.disconnect_by_func(self._elementInPointChangedCb)
+        bElement.disconnect_by_func(self._elementPriorityChangedCb)
+
+        record = self.records.pop(bElement)
+        self._layerIndexes[record.layer].remove(record)
+        brothers = self._clipRecords[record.clip]
+        brothers.remove(record)
+        if not brothers:
+            del self._clipRecords[record.clip]
+        if record.actor is not None:
+            self._unrealizeRecord(record)
+        if isinstance(record.preview, VideoPreviewer):
+            record.preview.release()
+        record.preview = None
+
+    def _realizeRecord(self, record, ease=True):
+        if self._elementPool:
+            element = self._elementPool.pop()
+            element.bind(record.bElement, record.track, record.preview)
+        else:
+            if self._compact:
+                element = CompactTimelineElement(record.bElement, record.track, self, record.preview)
+            else:
+                element = TimelineElement(record.bElement, record.track, self, record.preview)
+            element.set_z_position(-1)
+
+        record.actor = element
+        record.preview = element.preview
 
         self.elements.append(element)
 
-        self._setElementY(element)
+        self._setElementY(element, ease)
 
         self.add_child(element)
 
-        self._setElementX(element)
+        self._setElementX(element, ease)
+
+    def _unrealizeRecord(self, record):
+        element = record.actor
+        record.preview = element.unbind()
+        record.actor = None
+
+        self.elements.remove(element)
+        self.remove_child(element)
+        self._elementPool.append(element)
+
+    def _getViewportRange(self):
+        # Keep a page worth of elements realized on both sides, so they
+        # don't pop in while scrolling.
+        x, y, width, height = self._viewport
+        return self.pixelToNs(max(0, x - width)), self.pixelToNs(x + 2 * width)
+
+    def _isInViewport(self, record):
+        x, y, width, height = self._viewport
+        start, end = self._getViewportRange()
+        top = self._getElementY(record.bElement)
+        return (record.end >= start and record.start <= end and
+                top + EXPANDED_SIZE >= y and top <= y + height)
+
+    def _updateRealized(self, record):
+        if not self._virtualized or self._isInViewport(record):
+            if record.actor is None:
+                self._realizeRecord(record, False)
+        elif record.actor is not None and not record.actor.isDragged:
+            self._unrealizeRecord(record)
+
+    def _cullElements(self):
+        if not self._virtualized:
+            for record in self.records.itervalues():
+                self._updateRealized(record)
+            return
 
-    def _removeTimelineElement(self, track, bElement):
-        bElement.disconnect_by_func("notify::start", self._elementStartChangedCb)
-        bElement.disconnect_by_func("notify::duration", self._elementDurationChangedCb)
-        bElement.disconnect_by_func("notify::in-point", self._elementInPointChangedCb)
+        start, end = self._getViewportRange()
+        for record in self.elementsInRange(start, end):
+            self._updateRealized(record)
+
+        # Only the realized elements can have left the viewport
+        for element in list(self.elements):
+            self._updateRealized(self.records[element.bElement])
+
+    def _reindexRecord(self, record):
+        bElement = record.bElement
+        start = bElement.get_start()
+        end = start + bElement.get_duration()
+        layer = bElement.get_parent().get_layer()
+
+        if layer is record.layer:
+            self._layerIndexes[layer].move(record, start, end)
+        else:
+            self._layerIndexes[record.layer].remove(record)
+            record.start = start
+            record.end = end
+            record.layer = layer
+            self._layerIndexes.setdefault(layer, IntervalIndex()).add(record)
 
     def _setElementX(self, element, ease = True):
         if ease:
@@ -575,27 +1058,37 @@ class Timeline(Clutter.ScrollActor, Zoomable):
             element.restore_easing_state()
 
     # Crack, change that when we have retractable layers
-    def _setElementY(self, element):
-        element.save_easing_state()
+    def _getElementY(self, bElement):
         y = 0
-        bElement = element.bElement
         track_type = bElement.get_track_type()
 
         if (track_type == GES.TrackType.AUDIO):
             y = len(self.bTimeline.get_layers()) * (EXPANDED_SIZE + SPACING)
 
         y += bElement.get_parent().get_layer().get_priority() * (EXPANDED_SIZE + SPACING) + SPACING
+        return y
 
-        element.props.y = y
-        element.restore_easing_state()
+    def _setElementY(self, element, ease=True):
+        if ease:
+            element.save_easing_state()
+        element.props.y = self._getElementY(element.bElement)
+        if ease:
+            element.restore_easing_state()
 
     def _redraw(self):
         self.save_easing_state()
         self.props.width = self.nsToPixel(self.bTimeline.get_duration()) + 250
+        if self._virtualized:
+            self._cullElements()
         for element in self.elements:
-            self._setElementX(element)
+            self._setElementX(element, self.isElementVisible(element))
         self.restore_easing_state()
         self.playhead.props.x = self.nsToPixel(self.lastPosition)
+        self._updateThumbnailFocus()
+
+    def _updateThumbnailFocus(self):
+        x, y, width, height = self._viewport
+        ThumbnailService().setFocus(self.pixelToNs(x), self.pixelToNs(x + width))
 
     # Interface overrides (Zoomable)
 
@@ -607,6 +1100,8 @@ class Timeline(Clutter.ScrollActor, Zoomable):
     def _layerAddedCb(self, timeline, layer):
         for element in self.elements:
             self._setElementY(element)
+        if self._virtualized:
+            self._cullElements()
         self.save_easing_state()
         self.props.height = (len(self.bTimeline.get_layers()) + 1) * (EXPANDED_SIZE + SPACING) * 2 + SPACING
         self.restore_easing_state()
@@ -639,28 +1134,42 @@ class Timeline(Clutter.ScrollActor, Zoomable):
     def _trackElementRemovedCb(self, track, bElement):
         self._removeTimelineElement(track, bElement)
 
-    def _elementPriorityChangedCb(self, bElement, priority, element):
-        self._setElementY(element)
-
-    def _elementStartChangedCb(self, bElement, start, element):
+    def _elementPriorityChangedCb(self, bElement, priority, record):
+        self._reindexRecord(record)
+        self._updateRealized(record)
+        if record.actor is not None:
+            self._setElementY(record.actor)
+
+    def _elementStartChangedCb(self, bElement, start, record):
+        self._reindexRecord(record)
+        self._updateRealized(record)
+        element = record.actor
+        if element is None:
+            return
         if element.isDragged:
             self._setElementX(element, ease = False)
         else:
             self._setElementX(element)
 
-    def _elementDurationChangedCb(self, bElement, duration, element):
-        element.update(False)
+    def _elementDurationChangedCb(self, bElement, duration, record):
+        self._reindexRecord(record)
+        self._updateRealized(record)
+        if record.actor is not None:
+            record.actor.update(False)
 
-    def _elementInPointChangedCb(self, bElement, inpoint, element):
-        self._setElementX(element, ease = False)
+    def _elementInPointChangedCb(self, bElement, inpoint, record):
+        if record.actor is not None:
+            self._setElementX(record.actor, ease = False)
 
     def _layerPriorityChangedCb(self, layer, priority):
         self._redraw()
 
 def quit_(stage):
+    ThumbnailCache.flushAll()
     Gtk.main_quit()
 
 def quit2_(*args, **kwargs):
+    ThumbnailCache.flushAll()
     Gtk.main_quit()
 
 class ZoomBox(Gtk.HBox, Zoomable):
@@ -669,7 +1178,7 @@ class ZoomBox(Gtk.HBox, Zoomable):
         This will hold the widgets responsible for zooming.
         """
         Gtk.HBox.__init__(self)
-        Zoomable.__init__(self)
+        Zoomable.__init__(self, ZOOM_CONTROLS)
 
         self.timeline = timeline
 
@@ -850,7 +1359,8 @@ class TimelineTest(Zoomable):
     def __init__(self):
         gtksettings = Gtk.Settings.get_default()
         gtksettings.set_property("gtk-application-prefer-dark-theme", True)
-        Zoomable.__init__(self)
+        # Update the scrollbars before anything gets laid out.
+        Zoomable.__init__(self, ZOOM_CONTROLS, -1)
         GObject.threads_init()
         self.window = Gtk.Window()
         self.embed = GtkClutter.Embed()
@@ -895,11 +1405,16 @@ class TimelineTest(Zoomable):
 
         stage.add_child(widget)
         widget.set_position(CONTROL_WIDTH, 0)
+        widget.setVirtualized(True)
         stage.connect("destroy", quit_)
         stage.connect("button-press-event", self._clickedCb)
         self.timeline = widget
+        self._updateViewport()
+        self.embed.connect("size-allocate", self._embedSizeAllocateCb)
 
         self.scrolled = 0
+        # whether the next zoomChanged comes from a zoom around the playhead
+        self._scrollToPlayheadOnZoom = False
         self.window.show_all()
 #        self.ruler.hide()
 
@@ -951,11 +1466,23 @@ class TimelineTest(Zoomable):
         point.y = self.vadj.get_value()
         self.point = point
         self.timeline.scroll_to_point(point)
+        self._updateViewport()
         point.x = 0
         self.controls.scroll_to_point(point)
 
+    def _updateViewport(self):
+        allocation = self.embed.get_allocation()
+        self.timeline.setViewport(self.hadj.get_value(), self.vadj.get_value(),
+                                  allocation.width - CONTROL_WIDTH, allocation.height)
+
+    def _embedSizeAllocateCb(self, unused_embed, unused_allocation):
+        self._updateViewport()
+
     def zoomChanged(self):
         self.updateHScrollAdjustments()
+        if self._scrollToPlayheadOnZoom:
+            self._scrollToPlayheadOnZoom = False
+            self._scrollToPlayhead()
 
     def updateHScrollAdjustments(self):
         """
@@ -1053,7 +1580,8 @@ class TimelineTest(Zoomable):
 
     def _scrollToPlayhead(self):
         canvas_size = self.embed.get_allocation().width - CONTROL_WIDTH
-        new_pos = self.timeline.playhead.props.x
+        # The playhead actor itself only moves once the zoom change is delivered
+        new_pos = Zoomable.nsToPixel(self.timeline.lastPosition)
         scroll_pos = self.hadj.get_value()
         self.scrollToPosition(min(new_pos - canvas_size / 2,
                                   self.hadj.props.upper - canvas_size - 1))
@@ -1113,11 +1641,16 @@ class TimelineTest(Zoomable):
         # FIXME : see https://bugzilla.gnome.org/show_bug.cgi?id=697522
         deltas = event.get_scroll_deltas()
         if event.state & Gdk.ModifierType.CONTROL_MASK:
+            level = Zoomable.getCurrentZoomLevel()
             if deltas[2] < 0:
                 Zoomable.zoomIn()
             elif deltas[2] > 0:
                 Zoomable.zoomOut()
-            self._scrollToPlayhead()
+            if Zoomable.getCurrentZoomLevel() == level:
+                self._scrollToPlayhead()
+            else:
+                # The scrollbars only know the new size in zoomChanged
+                self._scrollToPlayheadOnZoom = True
         elif event.state & Gdk.ModifierType.SHIFT_MASK:
             if deltas[2] > 0:
                 self._scrollDown()
@@ -1155,27 +1688,35 @@ class TimelineTest(Zoomable):
 def get_preview_for_object(bElement):
     track_type = bElement.get_track_type()
     if track_type == GES.TrackType.AUDIO:
-        # FIXME: RandomAccessAudioPreviewer doesn't work yet
-        # previewers[key] = RandomAccessAudioPreviewer(instance, uri)
-        # TODO: return waveform previewer
-        return Clutter.Actor()
+        return WaveformPreviewer(bElement)
     elif track_type == GES.TrackType.VIDEO:
         if bElement.get_parent().is_image():
             # TODO: return still image previewer
             return Clutter.Actor()
+        elif USE_THUMBNAIL_ATLAS:
+            return AtlasVideoPreviewer(bElement)
         else:
             return VideoPreviewer(bElement)
     else:
         return Clutter.Actor()
 
 class VideoPreviewer(Clutter.Actor, Zoomable):
+    """
+    Shows thumbnails of a video clip.
+
+    The frames shown are taken from a pyramid of time grids, thumb_period
+    being the finest one, so that they are shared across zoom levels.
+    Until its frame is available, a thumbnail shows the frame of a coarser
+    grid if one is cached.
+    """
+
     def __init__(self, bElement):
         """
         @param bElement : the backend GES.TrackElement
         @param track : the track to which the bElement belongs
         @param timeline : the containing graphic timeline.
         """
-        Zoomable.__init__(self)
+        Zoomable.__init__(self, ZOOM_PREVIEWERS)
         Clutter.Actor.__init__(self)
 
         self.uri = bElement.props.uri
@@ -1193,77 +1734,94 @@ class VideoPreviewer(Clutter.Actor, Zoomable):
 
         self.thumb_margin = BORDER_WIDTH
         self.thumb_height = EXPANDED_SIZE - 2 * self.thumb_margin
-        # self.thumb_width will be set by self._setupPipeline()
+        # Placeholder until the size of the video is known, see _videoSizeCb
+        self.thumb_width = 16 * self.thumb_height / 9 # assume 16:9 aspect ratio
+        # Nothing is laid out until then, the cache holds thumbnails of the
+        # real width.
+        self._videoSizeKnown = False
 
         # TODO: read this property from the settings
         self.thumb_period = long(0.1 * Gst.SECOND)
+        self.thumb_levels = [self.thumb_period] + \
+            [level for level in THUMB_LEVELS if level > self.thumb_period]
 
-        # maps (quantized) times to Thumbnail objects
+        # maps the times of the frames shown to Thumbnail objects
         self.thumbs = {}
+        # hidden Thumbnail objects, to be reused by _addThumbnails
+        self._thumbPool = []
+        # the thumbnails are laid out every thumb_duration, see _addThumbnails
+        self.thumb_duration = self.thumb_period
+        # the time grid of the frames shown
+        self.thumb_level = self.thumb_period
 
-        self.thumb_cache = ThumbnailCache(uri=self.uri)
+        self.thumb_cache = ThumbnailCacheManager().getCache(self.uri)
 
-        self.queue = []
+        # maps the times being decoded to their ThumbnailJob
+        self.queue = {}
+        # maps jobs to the number of our times they still have to decode
+        self._jobRefs = collections.Counter()
+        # times of the thumbnails which come from keyframe seeks
+        self._approximate = set()
 
-        self.waiting_timestamp = None
-
-        self._setupPipeline();
+        self._service = ThumbnailService()
+        self._service.addPreviewer(self)
 
         self.callback_id = None
 
-    # Internal API
+        self._service.requestVideoSize(self.uri, self._videoSizeCb)
 
-    def _setupPipeline(self):
-        """
-        Create the pipeline.
+    # Public API
 
-        It has the form "playbin ! thumbnailsink" where thumbnailsink
-        is a Bin made out of "capsfilter ! gdkpixbufsink"
+    def focusChanged(self):
+        """
+        Requests the missing thumbnails around the part of the timeline the
+        user is looking at, and cancels the ones the user went away from.
         """
-        self.pipeline = Gst.ElementFactory.make("playbin", None)
-        self.pipeline.props.uri = self.uri
-        self.pipeline.props.flags = 1 # Only render video
+        horizon_start, horizon_end = self._service.getHorizon()
+        start = self.bElement.get_start()
 
-        # Set up the thumbnailsink
-        thumbnailsink = Gst.parse_bin_from_description("capsfilter caps=video/x-raw,format=(string)RGB,pixel-aspect-ratio=(fraction)1/1 ! gdkpixbufsink name=gdkpixbufsink", True)
+        for time in self.queue.keys():
+            if not horizon_start <= start + time <= horizon_end:
+                self._cancelThumbnail(time)
 
-        # get the gdkpixbufsink and the automatically created ghostpad
-        self.gdkpixbufsink = thumbnailsink.get_by_name("gdkpixbufsink")
-        sinkpad = thumbnailsink.get_static_pad("sink")
+        self._requestThumbnails([time for time in self._getThumbTimesInHorizon()
+                                 if not self.thumbs[time].loaded])
 
-        # Connect the playbin and the thumbnailsink
-        self.pipeline.props.video_sink = thumbnailsink
+    def release(self):
+        """
+        Cancels the pending requests, called when the clip is removed.
+        """
+        for time in self.queue.keys():
+            self._cancelThumbnail(time)
+        self._service.cancelVideoSize(self.uri, self._videoSizeCb)
+        if self.callback_id is not None:
+            GObject.source_remove(self.callback_id)
+            self.callback_id = None
 
-        # add a message handler that listens for the created pixbufs
-        self.pipeline.get_bus().add_signal_watch()
-        self.pipeline.get_bus().connect("message", self.bus_message_handler)
+    def refine(self):
+        """
+        Decodes again accurately the thumbnails around the visible range
+        which were obtained with keyframe seeks. Called when the
+        ThumbnailService is idle.
+        """
+        for time in self._getThumbTimesInHorizon():
+            if time in self._approximate and time not in self.queue:
+                self._queueRequest(time, self._service.request(self.uri, time,
+                    self._finishThumbnail, self.bElement.get_start() + time,
+                    refine=True))
 
-        self.pipeline.set_state(Gst.State.PAUSED)
-        # Wait for the pipeline to be prerolled so we can check the width
-        # that the thumbnails will have and set the aspect ratio accordingly
-        # as well as getting the framerate of the video:
-        change_return = self.pipeline.get_state(Gst.CLOCK_TIME_NONE)
-        if Gst.StateChangeReturn.SUCCESS == change_return[0]:
-            neg_caps = sinkpad.get_current_caps()[0]
-            video_width = neg_caps["width"]
-            video_height = neg_caps["height"]
-            self.thumb_width = video_width * self.thumb_height / video_height
-        else:
-            # the pipeline couldn't be prerolled so we can't determine the
-            # correct values. Set sane defaults (this should never happen)
-            self.warning("Couldn't preroll the pipeline")
-            self.thumb_width = 16 * self.thumb_height / 9 # assume 16:9 aspect ratio
+    # Internal API
 
     def _addThumbnails(self):
         """
         Adds thumbnails for the whole clip.
 
-        Takes the zoom setting into account and removes potentially
-        existing thumbnails prior to adding the new ones.
+        Takes the zoom setting into account. The existing thumbnails which
+        show a frame still needed are only moved, the others are hidden and
+        reused for the new ones.
         """
-        # TODO: check if duration or zoomratio really changed?
-        self.remove_all_children()
-        self.thumbs = {}
+        if not self._videoSizeKnown:
+            return
 
         # calculate unquantized length of a thumb in nano seconds
         thumb_duration_tmp = Zoomable.pixelToNs(self.thumb_width + self.thumb_margin)
@@ -1277,76 +1835,232 @@ class VideoPreviewer(Clutter.Actor, Zoomable):
 
         # make sure that we don't show thumbnails more often than thumb_period
         thumb_duration = max(thumb_duration, self.thumb_period)
+        self.thumb_duration = thumb_duration
+        self.thumb_level = self._getLevel(thumb_duration)
 
         number_of_thumbs = self.duration / thumb_duration
 
+        # maps the times of the frames to show to the position of their slot
+        slots = {}
         current_time = 0
         # +1 because wa want to draw the rightmost thumbnail even if it will be clipped
         for i in range(0, number_of_thumbs + 1):
-            thumb = Thumbnail(self.thumb_width, self.thumb_height)
-            thumb.set_position(Zoomable.nsToPixel(current_time), self.thumb_margin)
-            self.add_child(thumb)
-            self.thumbs[current_time] = thumb
-            self._thumbForTime(current_time)
+            slots[self._getGridTime(current_time)] = current_time
             current_time += thumb_duration
 
+        old_thumbs = self.thumbs
+        self.thumbs = {}
+        for time, thumb in old_thumbs.iteritems():
+            if time in slots and thumb.width == self.thumb_width:
+                self.thumbs[time] = thumb
+            else:
+                thumb.hide()
+                self._thumbPool.append(thumb)
+
+        for time, position in slots.iteritems():
+            thumb = self.thumbs.get(time)
+            if thumb is None:
+                thumb = self._getThumbnail()
+                self.thumbs[time] = thumb
+            thumb.set_position(Zoomable.nsToPixel(position), self.thumb_margin)
+
+        while len(self._thumbPool) > THUMB_POOL_SIZE:
+            self._destroyThumbnail(self._thumbPool.pop())
+
+        # The requests for the previous layout are stale now
+        for time in self.queue.keys():
+            if time not in self.thumbs:
+                self._cancelThumbnail(time)
+        self._approximate.intersection_update(self.thumbs)
+
+        # The others will be requested when the user gets close to them
+        self._requestThumbnails(list(self._getThumbTimesInHorizon()))
+
+    def _getThumbnail(self):
+        """
+        @returns: an empty Thumbnail child, from the pool if possible.
+        """
+        if not self._thumbPool:
+            return self._createThumbnail()
+
+        thumb = self._thumbPool.pop()
+        thumb.reset(self.thumb_width, self.thumb_height)
+        thumb.show()
+        return thumb
+
+    def _createThumbnail(self):
+        thumb = Thumbnail(self.thumb_width, self.thumb_height)
+        self.add_child(thumb)
+        return thumb
+
+    def _destroyThumbnail(self, thumb):
+        self.remove_child(thumb)
+
+    def _getThumbTimesInHorizon(self):
+        horizon_start, horizon_end = self._service.getHorizon()
+        start = self.bElement.get_start()
+        first = max(0, (horizon_start - start) // self.thumb_duration)
+        last = (horizon_end - start) // self.thumb_duration
+        for i in xrange(first, last + 1):
+            time = self._getGridTime(i * self.thumb_duration)
+            if time not in self.thumbs:
+                break
+            yield time
+
+    def _getLevel(self, thumb_duration):
+        """
+        @returns: the coarsest time grid keeping the frames shown within a
+        quarter of thumb_duration of their thumbnail.
+        """
+        level = self.thumb_period
+        for candidate in self.thumb_levels:
+            if 2 * candidate <= thumb_duration:
+                level = candidate
+        return level
+
+    def _getGridTime(self, time, level=None):
+        if level is None:
+            level = self.thumb_level
+        return (time + level // 2) // level * level
+
+    def _showCoarserThumbnail(self, time):
+        """
+        Shows the frame of the nearest coarser time grid which is cached,
+        while the one of time gets decoded.
+        """
+        for level in self.thumb_levels:
+            if level <= self.thumb_level:
+                continue
+            key = (self._getGridTime(time, level), self.thumb_height)
+            thumbnail_data = self.thumb_cache.get(key)
+            if thumbnail_data is not None and \
+                    self.thumbs[time].set_from_data(thumbnail_data, exact=False):
+                return
+
     def _thumbForTime(self, time):
-        if time in self.thumb_cache:
-            gdkpixbuf = self.thumb_cache[time]
-            self.thumbs[time].set_from_gdkpixbuf(gdkpixbuf)
-        else:
-            self._requestThumbnail(time)
+        """
+        @returns: whether the thumbnail could be taken from the cache.
+        """
+        thumbnail_data = self.thumb_cache.get((time, self.thumb_height))
+        if thumbnail_data is None:
+            return False
+        return self.thumbs[time].set_from_data(thumbnail_data)
+
+    def _requestThumbnails(self, times):
+        """
+        Gets the thumbnails for the given sorted times, from the cache or
+        from the ThumbnailService.
+        """
+        times = [time for time in times
+                 if time not in self.queue and not self._thumbForTime(time)]
+        if not times:
+            return
+
+        for time in times:
+            if not self.thumbs[time].coarse:
+                self._showCoarserThumbnail(time)
+
+        if not self._needsSequentialDecoding():
+            for time in times:
+                self._requestThumbnail(time)
+            return
+
+        run = [times[0]]
+        for time in times[1:]:
+            if time - run[-1] != self.thumb_duration:
+                self._requestRange(run)
+                run = []
+            run.append(time)
+        self._requestRange(run)
+
+    def _needsSequentialDecoding(self):
+        """
+        When thumbnails are only a few frames apart, decoding the whole
+        range once is cheaper than seeking for each of them.
+        """
+        frame_duration = self._service.getFrameDuration(self.uri)
+        if frame_duration is None:
+            return False
+        return self.thumb_duration <= SEQUENTIAL_DECODE_FRAMES * frame_duration
+
+    def _requestRange(self, times):
+        jobs = self._service.requestRange(self.uri, times[0],
+            times[-1] + self.thumb_duration, self.thumb_duration,
+            self._finishThumbnail, self.bElement.get_start() + times[0])
+        for time in times:
+            self._queueRequest(time, jobs[time])
+
+    def _queueRequest(self, time, job):
+        self.queue[time] = job
+        self._jobRefs[job] += 1
+
+    def _forgetThumbnailRequest(self, time):
+        """
+        @returns: the job which was decoding time, None if there was none or
+        if other times are still expected from it.
+        """
+        job = self.queue.pop(time, None)
+        if job is None:
+            return None
+
+        self._jobRefs[job] -= 1
+        if self._jobRefs[job] > 0:
+            return None
+        del self._jobRefs[job]
+        return job
+
+    def _cancelThumbnail(self, time):
+        job = self._forgetThumbnailRequest(time)
+        if job is not None:
+            self._service.cancel(job, self._finishThumbnail)
+
+    def _needsAccurateSeeks(self):
+        """
+        Keyframe seeks are much cheaper, and as good as accurate ones as
+        long as the thumbnails are further apart than the keyframes.
+        """
+        interval = self._service.getKeyframeInterval(self.uri)
+        if interval is None:
+            interval = KEYFRAME_INTERVAL_GUESS
+        return self.thumb_duration < interval
 
     def _requestThumbnail(self, time):
         """Queue a thumbnail request for the given time"""
-        if time not in self.queue:# and len(self._queue) <= self.max_requests:
-            if self.queue:
-                self.queue.append(time)
-            else:
-                self.queue.append(time)
-                self._nextThumbnail()
-
-    def _nextThumbnail(self):
-        """Notifies the preview object that the pipeline is ready to process
-        the next thumbnail in the queue. This should always be called from the
-        main application thread."""
-        if self.queue:
-            if not self._startThumbnail(self.queue[0]):
-                self.queue.pop(0)
-                self._nextThumbnail()
-        return False
-
-    def _startThumbnail(self, time):
-        self.waiting_timestamp = time
-        return self.pipeline.seek(1.0,
-            Gst.Format.TIME, Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
-            Gst.SeekType.SET, time,
-            Gst.SeekType.NONE, -1)
+        if time not in self.queue:
+            self._queueRequest(time, self._service.request(self.uri, time,
+                self._finishThumbnail, self.bElement.get_start() + time,
+                accurate=self._needsAccurateSeeks()))
 
     def _finishThumbnail(self, gdkpixbuf, time):
         """Notifies the preview object that the a new thumbnail is ready to be
-        cached. This should be called by subclasses when they have finished
-        processing the thumbnail for the current segment. This function should
-        always be called from the main thread of the application."""
-        waiting = self.waiting_timestamp
-        self.waiting_timestamp = None
+        cached. This is called by the ThumbnailService, from the main thread
+        of the application, with a None gdkpixbuf if decoding failed."""
+        job = self.queue.get(time)
+        if job is None:
+            # Cancelled, while other times of the job are still expected
+            return
+        self._forgetThumbnailRequest(time)
 
-        if time != waiting:
-            time = waiting
+        if gdkpixbuf is None:
+            # Don't try refining it over and over
+            self._approximate.discard(time)
+            return
 
         thumbnail = gdkpixbuf.scale_simple(self.thumb_width, self.thumb_height, 3)
 
-        self.thumb_cache[time] = thumbnail
+        if job.accurate:
+            self._approximate.discard(time)
+            self.thumb_cache[(time, self.thumb_height)] = thumbnail
+        else:
+            # Keep it out of the cache, which is shared with the other
+            # clips of the file and the other zoom levels, where it would
+            # pass for the exact frame.
+            self._approximate.add(time)
 
         if time in self.thumbs:
             self.thumbs[time].set_from_gdkpixbuf(thumbnail)
         #self.emit("update", time)
 
-        if time in self.queue:
-            self.queue.remove(time)
-        self._nextThumbnail()
-        return False
-
     # Interface (Zoomable)
 
     def _maybeUpdate(self):
@@ -1361,19 +2075,16 @@ class VideoPreviewer(Clutter.Actor, Zoomable):
 
     # Callbacks
 
-    def bus_message_handler(self, unused_bus, message):
-        if message.type == Gst.MessageType.ELEMENT and \
-                message.src == self.gdkpixbufsink:
-            struct = message.get_structure()
-
-            # TODO: does struct.get_name() work?
-            #if struct.get_name() == "pixbuf":
+    def _videoSizeCb(self, video_size):
+        if video_size is None:
+            # the pipeline couldn't be prerolled so we can't determine the
+            # correct values, keep the placeholder (this should never happen)
+            return
 
-            # TODO: there exists no value named "timestamp"
-            #self._finishThumbnail(struct.get_value("pixbuf"), struct.get_value("timestamp"))
-            GLib.idle_add(self._finishThumbnail, struct.get_value("pixbuf"),
-                    struct.get_value("timestamp"))
-        return Gst.BusSyncReply.PASS
+        video_width, video_height = video_size
+        self.thumb_width = video_width * self.thumb_height / video_height
+        self._videoSizeKnown = True
+        self._addThumbnails()
 
     #bElement = receiver()
 
@@ -1384,92 +2095,290 @@ class VideoPreviewer(Clutter.Actor, Zoomable):
         self.in_point = self.bElement.get_inpoint()
         GLib.idle_add(self._addThumbnails)
 
+class AtlasVideoPreviewer(VideoPreviewer):
+    """
+    A VideoPreviewer painting all of its thumbnails itself from the
+    ThumbnailTextureAtlas of its media file, instead of having an actor
+    and a texture per thumbnail.
+    """
+
+    def __init__(self, bElement):
+        self._atlas = None
+        self._placeholderColor = Cogl.Color()
+        self._placeholderColor.init_from_4ub(0, 100, 150, 100)
+        VideoPreviewer.__init__(self, bElement)
+
+    # Public API
+
+    def getAtlas(self):
+        """
+        @returns: the ThumbnailTextureAtlas for the current thumbnail size.
+        """
+        atlas = self._atlas
+        if atlas is None or (atlas.width, atlas.height) != (self.thumb_width, self.thumb_height):
+            atlas = ThumbnailTextureAtlas.get(self.thumb_cache.hash,
+                                              self.thumb_width, self.thumb_height)
+            self._atlas = atlas
+        return atlas
+
+    def release(self):
+        VideoPreviewer.release(self)
+        # Give the cells back to the atlas
+        for thumb in self.thumbs.values() + self._thumbPool:
+            thumb.hide()
+
+    # Internal API
+
+    def _addThumbnails(self):
+        VideoPreviewer._addThumbnails(self)
+        self.queue_redraw()
+
+    def _createThumbnail(self):
+        return AtlasThumbnail(self, self.thumb_width, self.thumb_height)
+
+    def _destroyThumbnail(self, thumb):
+        thumb.hide()
+
+    # Interface (Clutter.Actor)
+
+    def do_paint(self):
+        thumbs = [self.thumbs[time] for time in self._getThumbTimesInHorizon()]
+
+        # Same source for all the rectangles, so Cogl can batch them
+        Cogl.set_source_color(self._placeholderColor)
+        for thumb in thumbs:
+            Cogl.rectangle(thumb.x, thumb.y, thumb.x + thumb.width, thumb.y + thumb.height)
+
+        atlas = self._atlas
+        if atlas is None or atlas.texture is None:
+            return
+
+        Cogl.set_source_texture(atlas.texture)
+        for thumb in thumbs:
+            coords = atlas.getTextureCoords(thumb)
+            if coords is not None:
+                Cogl.rectangle_with_texture_coords(thumb.x, thumb.y,
+                    thumb.x + thumb.width, thumb.y + thumb.height, *coords)
+
+class WaveformPreviewer(Clutter.Actor, Zoomable):
+    """
+    Paints the waveform of an audio clip, from the L{Peaks} of its file.
+    Only the visible part is painted, from the finest level of peaks
+    having at most one peak per pixel.
+    """
+
+    def __init__(self, bElement):
+        """
+        @param bElement : the backend GES.TrackElement
+        """
+        Zoomable.__init__(self, ZOOM_PREVIEWERS)
+        Clutter.Actor.__init__(self)
+
+        self.bElement = bElement
+        self.peaks = None
+        self._peakColor = Cogl.Color()
+        self._peakColor.init_from_4ub(70, 79, 118, 200)
+        self._rmsColor = Cogl.Color()
+        self._rmsColor.init_from_4ub(118, 137, 196, 230)
+
+        PeakService().requestPeaks(bElement.props.uri, self._peaksCb)
+
+    # Internal API
+
+    def _getVisibleRange(self):
+        """
+        @returns: the (start, end) pixels of the previewer which are visible.
+        """
+        focus_start, focus_end = ThumbnailService().getFocus()
+        start = self.bElement.get_start()
+        width = self.get_width()
+        if focus_start == focus_end:
+            # The timeline didn't tell yet
+            return 0, width
+        return (max(0, Zoomable.nsToPixel(focus_start - start)),
+                min(width, Zoomable.nsToPixel(focus_end - start)))
+
+    # Interface (Zoomable)
+
+    def zoomChanged(self):
+        self.queue_redraw()
+
+    # Interface (Clutter.Actor)
+
+    def do_paint(self):
+        if self.peaks is None:
+            return
+
+        samples_per_pixel = float(WAVEFORM_RATE) / Zoomable.zoomratio
+        level = self.peaks.getLevel(samples_per_pixel)
+        window = self.peaks.getWindow(level)
+        values = self.peaks.levels[level]
+        pixels_per_peak = window / samples_per_pixel
+
+        x_start, x_end = self._getVisibleRange()
+        # The sample at the left of the clip
+        offset = float(self.bElement.get_inpoint()) * WAVEFORM_RATE / Gst.SECOND
+        first = max(0, int((offset + x_start * samples_per_pixel) // window))
+        last = min(len(values) // 3, int((offset + x_end * samples_per_pixel) // window) + 1)
+
+        middle = self.get_height() / 2.0
+        scale = middle / 32768.0
+        x_offset = offset / samples_per_pixel
+
+        # One color at a time, so Cogl can batch the rectangles
+        Cogl.set_source_color(self._peakColor)
+        for i in xrange(first, last):
+            x = i * pixels_per_peak - x_offset
+            Cogl.rectangle(x, middle - values[3 * i + 1] * scale,
+                           x + pixels_per_peak, middle - values[3 * i] * scale)
+        Cogl.set_source_color(self._rmsColor)
+        for i in xrange(first, last):
+            x = i * pixels_per_peak - x_offset
+            rms = values[3 * i + 2] * scale
+            Cogl.rectangle(x, middle - rms, x + pixels_per_peak, middle + rms)
+
+    # Callbacks
+
+    def _peaksCb(self, peaks):
+        self.peaks = peaks
+        self.queue_redraw()
+
 class Thumbnail(Clutter.Actor):
 
     def __init__(self, width, height):
         Clutter.Actor.__init__(self)
-        image = Clutter.Image.new()
-        self.props.content = image
+        self.image = Clutter.Image.new()
+        self.set_background_color(Clutter.Color.new(0, 100, 150, 100))
+        self.reset(width, height)
+
+    def reset(self, width, height):
+        """
+        Empties the thumbnail so that it can be reused.
+        """
+        # The image is only shown once it has been set again
+        self.props.content = None
         self.width = width
         self.height = height
-        self.set_background_color(Clutter.Color.new(0, 100, 150, 100))
+        self.loaded = False
+        # whether it shows a frame of a coarser time grid
+        self.coarse = False
         self.set_size(self.width, self.height)
 
     def set_from_gdkpixbuf(self, gdkpixbuf):
+        """
+        @returns: False if gdkpixbuf doesn't have the size of the thumbnail.
+        """
+        if (gdkpixbuf.get_width(), gdkpixbuf.get_height()) != (self.width, self.height):
+            return False
         row_stride = gdkpixbuf.get_rowstride()
         pixel_data = gdkpixbuf.get_pixels()
         # Cogl.PixelFormat.RGB_888 := 2
-        self.props.content.set_data(pixel_data, Cogl.PixelFormat.RGB_888, self.width, self.height, row_stride)
-
-# TODO: replace with utils.misc.hash_file
-def hash_file(uri):
-    """Hashes the first 256KB of the specified file"""
-    sha256 = hashlib.sha256()
-    with open(uri, "rb") as file:
-        for _ in range(1024):
-            chunk = file.read(256)
-            if not chunk:
-                break
-            sha256.update(chunk)
-    return sha256.hexdigest()
+        self.image.set_data(pixel_data, Cogl.PixelFormat.RGB_888,
+            gdkpixbuf.get_width(), gdkpixbuf.get_height(), row_stride)
+        self.props.content = self.image
+        self.loaded = True
+        self.coarse = False
+        return True
+
+    def set_from_data(self, thumbnail_data, exact=True):
+        """
+        @param thumbnail_data: a L{ThumbnailData}, as returned by the
+        ThumbnailCache.
+        @param exact: False if it is a placeholder from a coarser time grid.
+        @returns: False if thumbnail_data doesn't have the size of the
+        thumbnail.
+        """
+        if (thumbnail_data.width, thumbnail_data.height) != (self.width, self.height):
+            return False
+        self.image.set_data(thumbnail_data.data, Cogl.PixelFormat.RGB_888,
+            thumbnail_data.width, thumbnail_data.height, thumbnail_data.rowstride)
+        self.props.content = self.image
+        self.loaded = exact
+        self.coarse = not exact
+        return True
 
-# TODO: remove eventually
-autocreate = True
+class AtlasThumbnail(object):
 
-# TODO: replace with pitivi.settings.get_dir
-def get_dir(path, autocreate=True):
-    if autocreate and not os.path.exists(path):
-        os.makedirs(path)
-    return path
+    """Stands for a Thumbnail in an AtlasVideoPreviewer, which paints it
+    from the cell it owns in a ThumbnailTextureAtlas."""
 
-class ThumbnailCache(object):
+    def __init__(self, previewer, width, height):
+        object.__init__(self)
+        self._previewer = weakref.ref(previewer)
+        self._atlas = None
+        self.x = 0
+        self.y = 0
+        self.visible = True
+        self.reset(width, height)
+
+    def reset(self, width, height):
+        """
+        Empties the thumbnail so that it can be reused.
+        """
+        self._release()
+        self.width = width
+        self.height = height
+        self.loaded = False
+        # whether it shows a frame of a coarser time grid
+        self.coarse = False
 
-    """Caches thumbnails by key using LRU policy, implemented with heapq.
+    def set_position(self, x, y):
+        # The previewer redraws once it laid all of them out
+        self.x = x
+        self.y = y
 
-    Uses a two stage caching mechanism. A limited number of elements are
-    held in memory, the rest is being cached on disk using an sqlite db."""
+    def show(self):
+        self.visible = True
 
-    def __init__(self, uri):
-        object.__init__(self)
-        # TODO: replace with utils.misc.hash_file
-        self.hash = hash_file(Gst.uri_get_location(uri))
-        # TODO: replace with pitivi.settings.xdg_cache_home()
-        cache_dir = get_dir(os.path.join(xdg_dirs.xdg_cache_home, "pitivi"), autocreate)
-        dbfile = os.path.join(get_dir(os.path.join(cache_dir, "thumbs")), self.hash)
-        self.conn = sqlite3.connect(dbfile)
-        self.cur = self.conn.cursor()
-        self.cur.execute("CREATE TABLE IF NOT EXISTS Thumbs (Time INTEGER NOT NULL PRIMARY KEY,\
-            Data BLOB NOT NULL, Width INTEGER NOT NULL, Height INTEGER NOT NULL, Stride INTEGER NOT NULL)")
-
-    def __contains__(self, key):
-        # check if item is present in on disk cache
-        self.cur.execute("SELECT Time FROM Thumbs WHERE Time = ?", (key,))
-        if self.cur.fetchone():
-            return True
-        return False
+    def hide(self):
+        self.visible = False
+        self._release()
+
+    def set_from_gdkpixbuf(self, gdkpixbuf):
+        if not self._upload(gdkpixbuf.get_pixels(), gdkpixbuf.get_width(),
+                            gdkpixbuf.get_height(), gdkpixbuf.get_rowstride()):
+            return False
+        self.loaded = True
+        self.coarse = False
+        return True
+
+    def set_from_data(self, thumbnail_data, exact=True):
+        """
+        See L{Thumbnail.set_from_data}.
+        """
+        if not self._upload(thumbnail_data.data, thumbnail_data.width,
+                            thumbnail_data.height, thumbnail_data.rowstride):
+            return False
+        self.loaded = exact
+        self.coarse = not exact
+        return True
+
+    def evicted(self):
+        """
+        Called by the atlas when it takes the cell of the thumbnail back.
+        """
+        self._atlas = None
+        self.loaded = False
+        self.coarse = False
+
+    def _upload(self, data, width, height, rowstride):
+        previewer = self._previewer()
+        if previewer is None or (width, height) != (self.width, self.height):
+            return False
+
+        atlas = previewer.getAtlas()
+        if atlas is not self._atlas:
+            self._release()
+        if not atlas.upload(self, data, width, height, rowstride):
+            return False
+        self._atlas = atlas
+        previewer.queue_redraw()
+        return True
 
-    def __getitem__(self, key):
-        self.cur.execute("SELECT * FROM Thumbs WHERE Time = ?", (key,))
-        row = self.cur.fetchone()
-        if row:
-            pixbuf = GdkPixbuf.Pixbuf.new_from_data(row[1],
-                                                    GdkPixbuf.Colorspace.RGB,
-                                                    False,
-                                                    8,
-                                                    row[2],
-                                                    row[3],
-                                                    row[4],
-                                                    None,
-                                                    None)
-            return pixbuf
-        raise KeyError(key)
-
-    def __setitem__(self, key, value):
-        blob = sqlite3.Binary(bytearray(value.get_pixels()))
-        #Replace if the key already existed
-        self.cur.execute("DELETE FROM Thumbs WHERE  time=?", (key,))
-        self.cur.execute("INSERT INTO Thumbs VALUES (?,?,?,?,?)", (key, blob, value.get_width(), value.get_height(), value.get_rowstride()))
-        self.conn.commit()
+    def _release(self):
+        if self._atlas is not None:
+            self._atlas.release(self)
+            self._atlas = None
 
 if __name__ == "__main__":
     # Basic argument handling, no need for getopt here
@@ -20,8 +20,15 @@
 # Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
 # Boston, MA 02110-1301, USA.
 
+import bisect
+import heapq
+import itertools
+import time
+import weakref
+
 from gi.repository import GES
 from gi.repository import Gdk
+from gi.repository import GLib
 from gi.repository import Gst
 
 from mySignal import Signallable
@@ -38,6 +45,9 @@ SELECT_ADD = 2
 SELECT_BETWEEN = 3
 """Select a range of clips"""
 
+# Minimum interval between two edits of an EditingContext, in ms
+EDIT_INTERVAL = 16
+
 
 #------------------------------------------------------------------------------#
 #                          Timeline Object management helper                   #
@@ -201,6 +211,10 @@ class EditingContext(Signallable):
         Encapsulates interactive editing.
 
         This is the main class for interactive edition.
+
+        Edits are coalesced: only the latest position asked for is applied,
+        at most once every EDIT_INTERVAL ms, and not at all if it is the one
+        applied last. See L{getStats} for what it saved.
     """
 
     __signals__ = {
@@ -251,28 +265,107 @@ class EditingContext(Signallable):
         self.edge = edge
         self.mode = mode
 
+        # the (position, priority) to apply next and since when it waits
+        self._pending = None
+        self._pendingSince = None
+        self._applied = None
+        self._applyId = None
+        self._lastApplyTime = 0
+
+        # statistics, see getStats
+        self.requests = 0
+        self.edits = 0
+        self.skipped = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._startTime = time.time()
+
         self.timeline.enable_update(False)
 
     def finish(self):
         """Clean up timeline for normal editing"""
+        # The last position has to make it
+        self._flush()
         # TODO: post undo / redo action here
         self.timeline.enable_update(True)
         self.emit("clip-trim-finished")
 
+    def getStats(self):
+        """
+        @returns: a dict with the number of edit requests, of edits actually
+        applied, of edits skipped as they wouldn't change anything, the edits
+        applied per second, and the mean and max time in seconds a request
+        waited to be applied.
+        """
+        duration = time.time() - self._startTime
+        handled = self.edits + self.skipped
+        return {"requests": self.requests,
+                "edits": self.edits,
+                "skipped": self.skipped,
+                "edits_per_second": self.edits / duration if duration else 0.0,
+                "mean_latency": self.total_latency / handled if handled else 0.0,
+                "max_latency": self.max_latency}
+
     def setMode(self, mode):
         """Set the current editing mode.
         @param mode: the editing mode. Must be a GES.EditMode
         """
         self.mode = mode
+        # The same position can give a different result now
+        self._applied = None
 
     def editTo(self, position, priority):
+        """
+        Asks for the focus to be edited to position and priority, which
+        happens within EDIT_INTERVAL ms.
+        """
         position = max(0, position)
         if self.edge in [GES.Edge.EDGE_START, GES.Edge.EDGE_END]:
             priority = -1
         else:
             priority = max(0, priority)
 
-        res = self.focus.edit([], priority, self.mode, self.edge, long(position))
+        self.requests += 1
+        self._pending = (long(position), priority)
+        if self._pendingSince is None:
+            self._pendingSince = time.time()
+
+        if self._applyId is None:
+            elapsed = (time.time() - self._lastApplyTime) * 1000
+            delay = max(0, int(EDIT_INTERVAL - elapsed))
+            self._applyId = GLib.timeout_add(delay, self._applyCb)
+
+    def _flush(self):
+        if self._applyId is not None:
+            GLib.source_remove(self._applyId)
+            self._applyId = None
+        if self._pending is None:
+            return
+
+        now = time.time()
+        latency = now - self._pendingSince
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self._lastApplyTime = now
+
+        pending = self._pending
+        self._pending = None
+        self._pendingSince = None
+        if pending == self._applied:
+            self.skipped += 1
+            return
+
+        self._applied = pending
+        self.edits += 1
+        self._edit(*pending)
+
+    def _applyCb(self):
+        self._applyId = None
+        self._flush()
+        return False
+
+    def _edit(self, position, priority):
+        res = self.focus.edit([], priority, self.mode, self.edge, position)
         if res and self.mode == GES.EditMode.EDIT_TRIM:
             if self.edge == GES.Edge.EDGE_START:
                 self.emit("clip-trim", self.focus, self.focus.props.in_point)
@@ -284,6 +377,50 @@ class EditingContext(Signallable):
 
 ARROW = Gdk.Cursor.new(Gdk.CursorType.ARROW)
 
+
+class CursorManager(object):
+    """
+    Sets the cursor of the window of a widget. Each kind of cursor is only
+    created once, and setting the cursor which is already shown does
+    nothing.
+    """
+    # maps Gdk.CursorTypes to Gdk.Cursors, shared by all the managers
+    _cursors = {Gdk.CursorType.ARROW: ARROW}
+
+    def __init__(self, widget):
+        self._widget = widget
+        self._current = None
+
+    def setCursor(self, cursor_type):
+        """
+        @param cursor_type : a Gdk.CursorType
+        """
+        if cursor_type == self._current:
+            return
+
+        window = self._widget.get_window()
+        if window is None:
+            # Not realized yet
+            return
+
+        cursor = self._cursors.get(cursor_type)
+        if cursor is None:
+            cursor = Gdk.Cursor.new(cursor_type)
+            self._cursors[cursor_type] = cursor
+        window.set_cursor(cursor)
+        self._current = cursor_type
+
+
+# Zoomable categories
+ZOOM_CANVAS = "canvas"
+"""The timeline itself and its elements."""
+ZOOM_PREVIEWERS = "previewers"
+"""Thumbnails and waveforms."""
+ZOOM_RULERS = "rulers"
+"""Time rulers."""
+ZOOM_CONTROLS = "controls"
+"""Zoom controls and scrollbars."""
+
 class Zoomable(object):
     """
     Interface for managing tranformation between timeline timestamps and UI
@@ -306,10 +443,26 @@ class Zoomable(object):
     . setZoomRatio
     Instance Methods
     . zoomChanged()
+
+    zoomChanged() is not called synchronously: changes are coalesced and
+    delivered once, right before the next frame gets painted.
+
+    Instances are only weakly referenced, and are notified by increasing
+    priority, then by order of registration. A whole category can stop
+    being notified with suspendCategory() and catch up with
+    resumeCategory().
     """
 
     sigid = None
-    _instances = []
+    _zoomChangedSource = None
+    # maps categories to sorted lists of (priority, serial, weakref)
+    _instances = {}
+    _serial = itertools.count()
+    # the categories to notify at the next flush
+    _pendingCategories = set()
+    # the categories not notified for now, and the ones which missed a change
+    _suspended = set()
+    _stale = set()
     max_zoom = 1000.0
     min_zoom = 0.25
     zoom_steps = 100
@@ -317,24 +470,60 @@ class Zoomable(object):
     _cur_zoom = 2
     zoomratio = None
 
-    def __init__(self):
+    def __init__(self, category=ZOOM_CANVAS, priority=0):
+        """
+        @param category : one of the ZOOM_* categories.
+        @param priority : instances with a lower priority are notified first.
+        """
         # FIXME: ideally we should deprecate this
-        Zoomable.addInstance(self)
+        Zoomable.addInstance(self, category, priority)
         if Zoomable.zoomratio is None:
             Zoomable.zoomratio = self.computeZoomRatio(self._cur_zoom)
 
-    def __del__(self):
-        if self in Zoomable._instances:
-            # FIXME: ideally we should deprecate this and spit a warning here
-            self._instances.remove(self)
-
     @classmethod
-    def addInstance(cls, instance):
-        cls._instances.append(instance)
+    def addInstance(cls, instance, category=ZOOM_CANVAS, priority=0):
+        instances = cls._instances.setdefault(category, [])
+
+        def _instanceDiedCb(ref):
+            instances[:] = [entry for entry in instances if entry[2] is not ref]
+
+        entry = (priority, next(cls._serial), weakref.ref(instance, _instanceDiedCb))
+        bisect.insort(instances, entry)
 
     @classmethod
     def removeInstance(cls, instance):
-        cls._instances.remove(instance)
+        for instances in cls._instances.itervalues():
+            instances[:] = [entry for entry in instances if entry[2]() is not instance]
+
+    @classmethod
+    def countInstances(cls, category=None):
+        """
+        @returns: the number of live instances in category, or in all of them.
+        """
+        if category is None:
+            lists = cls._instances.values()
+        else:
+            lists = [cls._instances.get(category, [])]
+        return sum(1 for instances in lists for entry in instances
+                   if entry[2]() is not None)
+
+    @classmethod
+    def suspendCategory(cls, category):
+        """
+        Stops notifying the instances of category, until L{resumeCategory}.
+        """
+        cls._suspended.add(category)
+
+    @classmethod
+    def resumeCategory(cls, category):
+        """
+        Notifies the instances of category again, with the changes they
+        missed while suspended if any.
+        """
+        cls._suspended.discard(category)
+        if category in cls._stale:
+            cls._stale.discard(category)
+            cls._zoomChanged([category])
 
     @classmethod
     def setZoomRatio(cls, ratio):
@@ -398,9 +587,37 @@ class Zoomable(object):
         return int((float(duration) / Gst.SECOND) * cls.zoomratio)
 
     @classmethod
-    def _zoomChanged(cls):
-        for inst in cls._instances:
-            inst.zoomChanged()
+    def _zoomChanged(cls, categories=None):
+        """
+        @param categories : the categories to notify, all of them by default.
+        """
+        if categories is None:
+            categories = cls._instances.keys()
+        cls._pendingCategories.update(categories)
+        if cls._zoomChangedSource is None:
+            # Clutter paints at CLUTTER_PRIORITY_REDRAW (HIGH_IDLE + 50), after
+            # the pending input events, so all the zoom steps of a burst of
+            # scroll events end up in a single relayout before the next frame.
+            cls._zoomChangedSource = GLib.idle_add(cls._flushZoomChanged,
+                                                   priority=GLib.PRIORITY_HIGH_IDLE)
+
+    @classmethod
+    def _flushZoomChanged(cls):
+        cls._zoomChangedSource = None
+        categories = cls._pendingCategories
+        cls._pendingCategories = set()
+        # Copy, instances might come and go while being notified.
+        lists = []
+        for category in categories:
+            if category in cls._suspended:
+                cls._stale.add(category)
+            else:
+                lists.append(list(cls._instances.get(category, [])))
+        for unused_priority, unused_serial, ref in heapq.merge(*lists):
+            inst = ref()
+            if inst is not None:
+                inst.zoomChanged()
+        return False
 
     def zoomChanged(self):
         pass